@@ -1,6 +1,7 @@
 """Dmon
 
 Usage:
+  dmon --batch <path>... [options]
   dmon <wad> [options]
   dmon <wad> <pattern> [options]
   dmon (-h | --help | --about | --license)
@@ -14,11 +15,15 @@ Options:
                             '?' and '*' are wildcards eg:
                                 E1M* (all episode 1)
                                 MAP0[135] (MAP01, MAP03 and MAP05)
+  --batch                   Analyse many wads, given as files, directories
+                            or glob patterns. Results of all wads are
+                            combined into one output.
+  --maps=<pattern>          Match map names in --batch mode, as <pattern>.
   -a, --average             Combine results from multiple maps into
                             average amounts.
   -u, --bonus               Include berserk, soulsphere and megesphere
                             as data points.
-  -f <fmt>, --format=<fmt>  Set output format to: csv, json, dump
+  -f <fmt>, --format=<fmt>  Set output format to: csv, json, ndjson, dump
   -b <bl>, --baseline=<bl>  Set comparison baseline [Default: DOOM2]
                             where <bl> can be:
                                 DOOM, DOOM2, SIGIL,
@@ -34,6 +39,16 @@ Options:
   -p, --pivot               Pivot the output so that statistics are listed
                             as columns instead of rows.
                             Only applies when --format is not set.
+  --list                    List the maps with their thing and linedef
+                            counts, without analysing them.
+                            Only the csv --format applies.
+  --sectors                 List the things of each map with the index
+                            of the sector they are in.
+                            Only the csv --format applies.
+  -j <n>, --jobs=<n>        Analyse maps in <n> parallel processes
+                            [Default: 1]
+  --cache=<dir>             Keep the counts of analysed maps in a cache
+                            in <dir>, unchanged maps are not analysed again.
   --verbose                 Output debug messages.
 
 """
@@ -41,6 +56,12 @@ Options:
 
 import sys
 import os.path
+import csv
+try:
+    # the Python 2 csv module writes byte strings
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO
 from docopt import docopt
 import constants
 import baselines
@@ -62,16 +83,135 @@ def process_wad(options):
     if not test_file_exists(options):
         return
 
-    wad_data = dmoncommon.extract_statistics(options)
-
     fmt = options["--format"]
     if fmt is not None:
         fmt = fmt.upper()
-    
+
+    listing = options["--list"] or options["--sectors"]
+    if fmt in ("CSV", "NDJSON") and not listing:
+        stream_wad(options, fmt)
+        if options["--legend"] == True:
+            print_legend_flags(options)
+        return
+
+    if options["--list"]:
+        wad_data = dmoncommon.list_maps(options)
+    elif options["--sectors"]:
+        wad_data = dmoncommon.locate_things(options)
+    else:
+        wad_data = dmoncommon.extract_statistics(options)
+
     if len(wad_data["map list"]) == 0:
         map_pattern = options["<pattern>"] or "*"
         print("No maps in WAD, or none matched pattern '%s'."
         " An Imp tears your arm off." % (map_pattern))
+    else:
+        print_wad_data(wad_data, options, fmt)
+
+    if options["--legend"] == True:
+        print_legend_flags(options)
+
+
+def stream_wad(options, fmt):
+    """
+    Write the statistics of each map as CSV rows or NDJSON records,
+    as soon as the map is analysed.
+    """
+    filename = options["<wad>"]
+    writer = csv.writer(sys.stdout, lineterminator="\n")
+    totals = dmoncommon.new_running_totals()
+    count = 0
+
+    for map_name, map_data in dmoncommon.iter_statistics(options, totals):
+        if fmt == "CSV":
+            if count == 0:
+                writer.writerow(csv_header())
+            writer.writerows(csv_rows(filename, map_name, map_data))
+        else:
+            sys.stdout.write(to_ndjson(filename, map_name, map_data))
+        sys.stdout.flush()
+        count += 1
+
+    if count == 0:
+        map_pattern = options["<pattern>"] or "*"
+        print("No maps in WAD, or none matched pattern '%s'."
+        " An Imp tears your arm off." % (map_pattern))
+    elif fmt == "CSV":
+        print("")
+    elif options["--average"] == True:
+        _, averages = dmoncommon.averages_of(totals)
+        sys.stdout.write(to_ndjson(filename, "AVERAGES", averages))
+
+
+def process_batch(options):
+
+    fmt = options["--format"]
+    if fmt is not None:
+        fmt = fmt.upper()
+
+    if fmt not in (None, "CSV", "JSON", "NDJSON", "DUMP"):
+        print("Invalid output format '%s'."
+        " A Demon bites your face off." % (fmt))
+        return
+
+    filenames = dmoncommon.find_wad_files(options["<path>"])
+    results = dmoncommon.extract_batch_statistics(filenames, options)
+
+    # stream one combined csv table or json array
+    if fmt == "JSON":
+        sys.stdout.write("[\n")
+    written = 0
+    for filename, wad_data, error in results:
+        if error is not None:
+            sys.stderr.write("Skipping %s: %s\n" % (filename, error))
+            continue
+        if len(wad_data["map list"]) == 0:
+            sys.stderr.write("Skipping %s: no maps matched\n" % (filename))
+            continue
+        if fmt == "CSV":
+            if options["--list"]:
+                sys.stdout.write(map_list_to_csv(wad_data, written == 0))
+            elif options["--sectors"]:
+                sys.stdout.write(thing_sectors_to_csv(wad_data, written == 0))
+            else:
+                sys.stdout.write(to_csv(wad_data, options, written == 0))
+        elif fmt == "NDJSON":
+            map_list = list(wad_data["map list"])
+            if (options["--average"] == True and not options["--list"]
+                and not options["--sectors"]):
+                map_list.append("AVERAGES")
+            for map_name in map_list:
+                sys.stdout.write(to_ndjson(filename, map_name,
+                                           wad_data["data"][map_name]))
+        elif fmt == "JSON":
+            if written > 0:
+                sys.stdout.write(",\n")
+            sys.stdout.write(to_json(wad_data))
+        else:
+            print_wad_data(wad_data, options, fmt)
+        sys.stdout.flush()
+        written += 1
+    if fmt == "JSON":
+        sys.stdout.write("\n]\n")
+
+    if options["--legend"] == True:
+        print_legend_flags(options)
+
+
+def print_wad_data(wad_data, options, fmt):
+    """
+    Print the statistics of a wad in the fmt output format.
+    """
+    if options["--list"]:
+        if fmt == "CSV":
+            print(map_list_to_csv(wad_data))
+        else:
+            print(map_list_to_tabular(wad_data))
+    elif options["--sectors"]:
+        if fmt == "CSV":
+            print(thing_sectors_to_csv(wad_data))
+        else:
+            print(thing_sectors_to_tabular(wad_data))
     elif fmt is None:
         if options["--average"] == True:
             print(to_tabular(wad_data, options, True))
@@ -87,9 +227,6 @@ def process_wad(options):
         print("Invalid output format '%s'."
         " A Demon bites your face off." % (fmt))
 
-    if options["--legend"] == True:
-        print_legend_flags(options)
-
 
 def format_as_table(columns, rows, first_column_width=6, other_column_width=12):
     """
@@ -186,55 +323,122 @@ def to_tabular(wad_data, options, list_averages):
     return output
 
 
-def to_csv(wad_data, options):
+# raw map values in csv columns, after FILE, MAP and SKILL
+CSV_COLUMNS = (
+    ("MONSTERS", "monsters"),
+    ("HITSCANNERS", "hitscanners"),
+    ("HEALTH POINTS", "health points"),
+    ("ARMOR POINTS", "armor points"),
+    ("BULLETS", "bullets"),
+    ("SHELLS", "shells"),
+    ("ROCKETS", "rockets"),
+    ("CELLS", "plasma cells")
+)
+
+
+def csv_header():
     """
-    Output statistics as CSV data.
+    Return the CSV header row.
     """
-
-    csv = (
-        "FILE,MAP,"
-        "SKILL,"
-        "MONSTERS,"
-        "HITSCANNERS,"
-        "HEALTH POINTS,"
-        "ARMOR POINTS,"
-        "BULLETS,"
-        "SHELLS,"
-        "ROCKETS,"
-        "CELLS,"
-    )
-    
+    row = ["FILE", "MAP", "SKILL"]
+    row.extend(title for title, _ in CSV_COLUMNS)
     # Add derived stat columns
-    for col in constants.TITLES:
-        if col != "flags":
-            csv += col.upper() + ","
+    row.extend(col.upper() for col in constants.TITLES if col != "flags")
+    return row
+
+
+def csv_rows(filename, map_name, map_data):
+    """
+    Return the CSV rows of a map, one for each skill.
+    """
+    rows = []
+    for skill in constants.SKILLS:
+        skill_data = map_data[skill]
+        row = [filename, map_name, skill]
+        row.extend(skill_data[key] for _, key in CSV_COLUMNS)
+        # Add each derived value
+        row.extend(skill_data[col] for col in constants.TITLES
+                   if col != "flags")
+        rows.append(row)
+    return rows
 
-    # Trim trailing comma and end the line
-    csv = csv[:-1] + "\n"
 
+def to_csv(wad_data, options, header=True):
+    """
+    Output statistics as CSV data, optionally without the header row.
+    """
+    output = StringIO()
+    writer = csv.writer(output, lineterminator="\n")
+    if header:
+        writer.writerow(csv_header())
     # Add each map and skill as a row
+    for map_name in wad_data["map list"]:
+        writer.writerows(csv_rows(wad_data["filename"], map_name,
+                                  wad_data["data"][map_name]))
+    return output.getvalue()
+
+
+def to_ndjson(filename, map_name, map_data):
+    """
+    Output the statistics of a map as one line of JSON.
+    """
+    import json
+    record = {"file": filename, "map": map_name}
+    record.update(map_data)
+    return json.dumps(record) + "\n"
+
+
+def map_list_to_tabular(wad_data):
+    """
+    Output the map list as a table.
+    """
+    rows = []
     for map_name in wad_data["map list"]:
         map_data = wad_data["data"][map_name]
-        for skill in constants.SKILLS:
-            skill_data = map_data[skill]
-            csv += wad_data["filename"] + ","
-            csv += map_name + ","
-            csv += skill + ","
-            csv += str(skill_data["monsters"]) + ","
-            csv += str(skill_data["hitscanners"]) + ","
-            csv += str(skill_data["health points"]) + ","
-            csv += str(skill_data["armor points"]) + ","
-            csv += str(skill_data["bullets"]) + ","
-            csv += str(skill_data["shells"]) + ","
-            csv += str(skill_data["rockets"]) + ","
-            csv += str(skill_data["plasma cells"]) + ","
-            # Add each derived value
-            for col in constants.TITLES:
-                if col != "flags":
-                    csv += str(skill_data[col]) + ","
-            # Trim trailing comma and end the line
-            csv = csv[:-1] + "\n"
+        rows.append((map_name, map_data["things"], map_data["linedefs"]))
+    output = "\n[%s]\n" % (wad_data["filename"])
+    output += format_as_table(("", "THINGS", "LINEDEFS"), rows, 8, 10)
+    return output
 
+
+def map_list_to_csv(wad_data, header=True):
+    """
+    Output the map list as CSV data, optionally without the header row.
+    """
+    csv = "FILE,MAP,THINGS,LINEDEFS\n" if header else ""
+    for map_name in wad_data["map list"]:
+        map_data = wad_data["data"][map_name]
+        csv += "%s,%s,%d,%d\n" % (wad_data["filename"], map_name,
+                                  map_data["things"], map_data["linedefs"])
+    return csv
+
+
+def thing_sectors_to_tabular(wad_data):
+    """
+    Output the things of each map and their sectors as a table.
+    """
+    output = "\n[%s]\n" % (wad_data["filename"])
+    for map_name in wad_data["map list"]:
+        map_data = wad_data["data"][map_name]
+        rows = [(map_name if i == 0 else "", i, thing_type, sector)
+                for i, (thing_type, sector)
+                in enumerate(zip(map_data["types"], map_data["sectors"]))]
+        output += format_as_table(("", "THING", "TYPE", "SECTOR"), rows, 8, 8)
+    return output
+
+
+def thing_sectors_to_csv(wad_data, header=True):
+    """
+    Output the things of each map and their sectors as CSV data,
+    optionally without the header row.
+    """
+    csv = "FILE,MAP,THING,TYPE,SECTOR\n" if header else ""
+    for map_name in wad_data["map list"]:
+        map_data = wad_data["data"][map_name]
+        for i, (thing_type, sector) in enumerate(zip(map_data["types"],
+                                                     map_data["sectors"])):
+            csv += "%s,%s,%d,%d,%d\n" % (wad_data["filename"], map_name,
+                                         i, thing_type, sector)
     return csv
 
 
@@ -296,14 +500,30 @@ def valid_baseline_specified(options):
         return False
 
 
+def valid_jobs_specified(options):
+    jobs = options["--jobs"]
+    if jobs.isdigit() and int(jobs) > 0:
+        return True
+    else:
+        print("%s is not a valid number of jobs. "
+        "A Mancubus roasts you alive." % (jobs))
+        return False
+
+
 def main():
     options = docopt(__doc__, version=__version__)
     if isinstance(options, dict):
         if not valid_baseline_specified(options):
             sys.exit(255)
 
+        if not valid_jobs_specified(options):
+            sys.exit(255)
+
         if not process_help_and_about_options(options):
-            process_wad(options)
+            if options["--batch"]:
+                process_batch(options)
+            else:
+                process_wad(options)
     else:
         print(options)
 
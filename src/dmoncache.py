@@ -0,0 +1,56 @@
+import hashlib
+import json
+import os
+import sqlite3
+import constants
+
+CACHE_FILENAME = "dmon-cache.sqlite"
+
+
+def cache_key(things, hexen, with_bonus):
+    """
+    Return the cache key of a map, from the bytes of its THINGS lump and
+    the options that change the raw counts. The dmon version is part of
+    the key, so updated lookup tables never return stale counts.
+    """
+    digest = hashlib.sha1(things)
+    digest.update(("|%s|%d|%d" % (constants.VERSION, bool(hexen),
+                                  bool(with_bonus))).encode("ascii"))
+    return digest.hexdigest()
+
+
+class ResultCache(object):
+    """
+    Raw per-skill map counters, as built by analyse_map, stored in a
+    SQLite database in a cache directory. Derived values are never
+    cached, they depend on the baseline and output options.
+    """
+
+    def __init__(self, directory):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        path = os.path.join(directory, CACHE_FILENAME)
+        # batch workers may share the cache, wait for their writes
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS maps "
+            "(key TEXT PRIMARY KEY, data TEXT NOT NULL)")
+
+    def get(self, key):
+        """Return the cached map data of key, or None."""
+        row = self.connection.execute(
+            "SELECT data FROM maps WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def put(self, key, map_data):
+        """Store the map data of key."""
+        self.connection.execute(
+            "INSERT OR REPLACE INTO maps (key, data) VALUES (?, ?)",
+            (key, json.dumps(map_data)))
+
+    def close(self):
+        """Commit stored map data and close the database."""
+        self.connection.commit()
+        self.connection.close()
@@ -1,8 +1,16 @@
+import glob
 import numbers
+import os
+from collections import Counter
 import lookup
 import baselines
 import constants
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 def count_if(func, id):
     """
     Return a counter if func returns True.
@@ -132,124 +140,519 @@ def new_totals_object(columns):
     return n
 
 
-def extract_statistics(options):
-    """Perform statistics extraction on a wad."""
+# thing flag bit of each skill level
+SKILL_FLAGS = {
+    "easy": 1,
+    "medium": 2,
+    "hard": 4
+}
+
+
+def iter_things(wadio, lumps):
+    """
+    Yield the type and flags of each thing in a map, as listed by
+    WadIO.find_maps. Only the THINGS lump is read, the records are
+    unpacked directly instead of building a MapEditor.
+    """
+
+    from omg import omg
+    from omg.util import iter_unpack
+    if "BEHAVIOR" in lumps:
+        # hexen format: tid, x, y, height, angle, type, flags, action, args
+        thing_struct = omg.ZThing
+        type_index = 5
+    else:
+        # doom format: x, y, angle, type, flags
+        thing_struct = omg.Thing
+        type_index = 3
+
+    data = wadio.read(lumps["THINGS"])
+    # ignore a truncated trailing record
+    data = data[:len(data) - len(data) % thing_struct._fmtsize]
+
+    for record in iter_unpack(thing_struct._struct, data):
+        yield record[type_index], record[type_index + 1]
+
+
+# thing traits summed into each skill, in trait table column order
+TRAIT_COLUMNS = [
+    "hitscanners",
+    "meaty monsters",
+    "health points",
+    "armor points",
+    "shells",
+    "bullets",
+    "monster hit points",
+    "monster attack points",
+    "rockets",
+    "plasma cells"
+]
+
+# trait tables already built, by bonus setting
+_trait_tables = {}
+
+
+def trait_table(with_bonus):
+    """
+    Return the traits of every thing type as a dense table, indexed by
+    type with one column per TRAIT_COLUMNS entry. Types past the end of
+    the table have no traits. The table is a numpy array if available,
+    otherwise a list of tuples.
+    """
+
+    with_bonus = bool(with_bonus)
+    if with_bonus in _trait_tables:
+        return _trait_tables[with_bonus]
+
+    known_types = set()
+    for traits in (lookup.hitscanner, lookup.meaty, lookup.health,
+                   lookup.health_bonus, lookup.armor, lookup.armor_bonus,
+                   lookup.shells, lookup.bullets, lookup.rockets,
+                   lookup.plasma, lookup.monster_hp, lookup.monster_ap):
+        known_types.update(traits)
+
+    blank = (0,) * len(TRAIT_COLUMNS)
+    table = [blank] * (max(known_types) + 1)
+    for id in known_types:
+        table[id] = (
+            count_if(is_hitscanner, id),
+            count_if(is_meaty, id),
+            health_points_of(id, with_bonus),
+            armor_points_of(id, with_bonus),
+            shells_of(id),
+            bullets_of(id),
+            hit_points_of(id),
+            attack_points_of(id),
+            rockets_of(id),
+            plasma_of(id)
+        )
+
+    if numpy is not None:
+        table = numpy.array(table, dtype=numpy.int64)
+
+    _trait_tables[with_bonus] = table
+    return table
+
+
+def thing_columns(wadio, lumps):
+    """
+    Return the types and flags of all things in a map, as numpy
+    arrays if available, otherwise as lists.
+    """
+
+    if numpy is None:
+        pairs = list(iter_things(wadio, lumps))
+        return [p[0] for p in pairs], [p[1] for p in pairs]
+
+    from omg import omg
+    if "BEHAVIOR" in lumps:
+        thing_struct = omg.ZThing
+        type_index = 5
+    else:
+        thing_struct = omg.Thing
+        type_index = 3
+
+    # view the records as rows of 16 bit words, type and flags are
+    # word aligned in both formats
+    data = wadio.read(lumps["THINGS"])
+    count = len(data) // thing_struct._fmtsize
+    words = numpy.frombuffer(data, dtype="<u2",
+                             count=count * thing_struct._fmtsize // 2)
+    words = words.reshape(count, thing_struct._fmtsize // 2)
+    return words[:, type_index], words[:, type_index + 1]
+
+
+def sum_traits(types, flags, table):
+    """
+    Sum the traits of things per skill level. Returns a dict of
+    skill name to a list of totals in TRAIT_COLUMNS order.
+    """
+
+    totals = {}
+
+    if numpy is not None and isinstance(types, numpy.ndarray):
+        rows = len(table)
+        for skill_name, bit in SKILL_FLAGS.items():
+            counts = numpy.bincount(types[(flags & bit) != 0],
+                                    minlength=rows)[:rows]
+            totals[skill_name] = [int(n) for n in counts.dot(table)]
+        return totals
+
+    # histogram of type and skill bits, traits are looked up once
+    # for each distinct combination
+    histogram = Counter(zip(types, (f & 7 for f in flags)))
+    for skill_name in SKILL_FLAGS:
+        totals[skill_name] = [0] * len(TRAIT_COLUMNS)
+    for (id, skill_bits), count in histogram.items():
+        if id >= len(table):
+            continue
+        row = table[id]
+        for skill_name, bit in SKILL_FLAGS.items():
+            if skill_bits & bit:
+                skill_total = totals[skill_name]
+                for i, value in enumerate(row):
+                    skill_total[i] += int(value) * count
+    return totals
+
+
+def analyse_map(wadio, lumps, table):
+    """Return a new map data object with the thing traits of a map."""
+
+    map_data = new_map_data_object()
+
+    types, flags = thing_columns(wadio, lumps)
+    totals = sum_traits(types, flags, table)
+
+    # store traits into skill groups
+    for skill_name, skill_total in totals.items():
+        skill = map_data[skill_name]
+        for key, value in zip(TRAIT_COLUMNS, skill_total):
+            skill[key] += value
+
+    return map_data
+
+
+def analyse_maps(filename, maps, with_bonus):
+    """
+    Analyse a chunk of maps in a worker process. maps is a list of
+    (map name, lumps) as listed by WadIO.find_maps. The worker opens
+    the wad itself, so no lump data is sent between processes.
+    """
+
+    from omg import omg
+    wadio = omg.WadIO(filename, use_mmap=True)
+    table = trait_table(with_bonus)
+    return [analyse_map(wadio, lumps, table) for _, lumps in maps]
+
+
+def pool_map(function, items, jobs):
+    """
+    Yield function(item) for each item, in order, computed across a
+    pool of jobs processes. Python 2 has no concurrent.futures, there
+    a multiprocessing pool is used.
+    """
+
+    try:
+        from concurrent.futures import ProcessPoolExecutor
+    except ImportError:
+        from multiprocessing import Pool
+        pool = Pool(jobs)
+        try:
+            for result in pool.imap(function, items):
+                yield result
+        finally:
+            pool.terminate()
+            pool.join()
+        return
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        for result in executor.map(function, items):
+            yield result
+
+
+def analyse_maps_in_pool(filename, maps, with_bonus, jobs):
+    """
+    Analyse maps across a pool of jobs processes.
+    Yields map data objects in the order of maps.
+    """
+
+    from functools import partial
+
+    # a few chunks per job evens out maps of different sizes
+    chunk_size = max(1, -(-len(maps) // (jobs * 4)))
+    chunks = [maps[i:i + chunk_size] for i in range(0, len(maps), chunk_size)]
+
+    analyse = partial(analyse_maps, filename, with_bonus=with_bonus)
+    for chunk_data in pool_map(analyse, chunks, jobs):
+        for map_data in chunk_data:
+            yield map_data
+
+
+def iter_statistics(options, totals=None):
+    """
+    Perform statistics extraction on a wad, yielding (map name, map data)
+    with derived answers as each map is analysed, in map order.
+    When given, running totals are updated with each map.
+    """
 
     filename = options["<wad>"]
     map_pattern = options["<pattern>"] or "*"
 
+    # open the wad, only the things lump of each map gets read
+    from omg import omg
+    wadio = omg.WadIO(filename, use_mmap=True)
+
+    # the maps in the map pattern that have things
+    maps = []
+    for map_name, lumps in wadio.find_maps(map_pattern).items():
+
+        if options["--verbose"]:
+            print("Loading map " + map_name)
+
+        if "THINGS" not in lumps:
+            if options["--verbose"]:
+                print("Skipping {map_name} Lump".format(map_name=map_name))
+            continue
+
+        maps.append((map_name, lumps))
+
+    # look up maps in the result cache, only missing maps get analysed
+    results = [None] * len(maps)
+    cache = None
+    if options["--cache"]:
+        import dmoncache
+        cache = dmoncache.ResultCache(options["--cache"])
+        keys = [dmoncache.cache_key(wadio.read(lumps["THINGS"]),
+                                    "BEHAVIOR" in lumps, options["--bonus"])
+                for _, lumps in maps]
+        for i, key in enumerate(keys):
+            results[i] = cache.get(key)
+    missing_maps = [m for m, map_data in zip(maps, results) if map_data is None]
+
+    jobs = int(options["--jobs"])
+    if jobs > 1 and len(missing_maps) > 1:
+        analysed = analyse_maps_in_pool(filename, missing_maps,
+                                        options["--bonus"], jobs)
+    else:
+        table = trait_table(options["--bonus"])
+        analysed = (analyse_map(wadio, lumps, table)
+                    for _, lumps in missing_maps)
+
+    try:
+        for i, (map_name, _) in enumerate(maps):
+            map_data = results[i]
+            if map_data is None:
+                map_data = next(analysed)
+                if cache is not None:
+                    cache.put(keys[i], map_data)
+            derive_map_answers(map_data, options)
+            if totals is not None:
+                add_to_totals(totals, map_data)
+            yield map_name, map_data
+    finally:
+        if cache is not None:
+            cache.close()
+
+
+def extract_statistics(options):
+    """Perform statistics extraction on a wad."""
+
     # store all stats for the wad in here.
     # map list: ordered list of map names in this data object.
+    wad_data = {
+        "filename": options["<wad>"],
+        "map list": [],
+        "data": {}
+    }
+
+    totals = new_running_totals()
+    for map_name, map_data in iter_statistics(options, totals):
+        wad_data["map list"].append(map_name)
+        wad_data["data"][map_name] = map_data
+
+    # sum, calculate & derive answers
+    if len(wad_data["map list"]) > 0:
+        wad_data["totals"], wad_data["data"]["AVERAGES"] = averages_of(totals)
+        format_results(wad_data, options)
+
+    return wad_data
+
+
+def list_maps(options):
+    """
+    List the maps in a wad with their thing and linedef counts.
+    Only the WAD directory is read, the counts come from lump sizes.
+    """
+
+    filename = options["<wad>"]
+    map_pattern = options["<pattern>"] or "*"
+
     wad_data = {
         "filename": filename,
         "map list": [],
         "data": {}
     }
 
-    # open the wad
     from omg import omg
-    wad = omg.WAD()
-    wad.from_file(filename)
+    wadio = omg.WadIO(filename)
 
-    # iterate each map in the map pattern
-    for map_name in wad.maps.find(map_pattern):
+    for map_name, lumps in wadio.find_maps(map_pattern).items():
+        # hexen format maps have larger things and linedefs
+        if "BEHAVIOR" in lumps:
+            thing_size = omg.ZThing._fmtsize
+            linedef_size = omg.ZLinedef._fmtsize
+        else:
+            thing_size = omg.Thing._fmtsize
+            linedef_size = omg.Linedef._fmtsize
 
-        if options["--verbose"]:
-            print("Loading map " + map_name)
+        map_data = {"things": 0, "linedefs": 0}
+        if "THINGS" in lumps:
+            map_data["things"] = wadio.entries[lumps["THINGS"]].size // thing_size
+        if "LINEDEFS" in lumps:
+            map_data["linedefs"] = wadio.entries[lumps["LINEDEFS"]].size // linedef_size
+
+        wad_data["map list"].append(map_name)
+        wad_data["data"][map_name] = map_data
+
+    return wad_data
 
-        # use the map editor object to interrogate things
+
+def locate_things(options):
+    """
+    List the things of each map with the sector they are in, found by
+    walking the BSP nodes of the map. The data of each map holds the
+    type and sector of every thing, in THINGS order.
+    """
+
+    filename = options["<wad>"]
+    map_pattern = options["<pattern>"] or "*"
+
+    wad_data = {
+        "filename": filename,
+        "map list": [],
+        "data": {}
+    }
+
+    from omg import omg
+    wadio = omg.WadIO(filename, use_mmap=True)
+
+    for map_name, lumps in wadio.find_maps(map_pattern).items():
+        group = dict((name, omg.Lump(wadio.read(index)))
+                     for name, index in lumps.items())
         try:
-            edit = omg.MapEditor(wad.maps[map_name])
-        except KeyError:
+            edit = omg.MapEditor(group)
+        except ValueError as e:
             if options["--verbose"]:
-                print("Skipping {map_name} Lump".format(map_name=map_name))
+                print("Skipping {map_name}: {error}".format(map_name=map_name,
+                                                           error=e))
             continue
 
-        # store the map data in wad stat
-        map_data = new_map_data_object()
+        things = edit.things
+        map_data = {
+            "types": [thing.type for thing in things],
+            "sectors": edit.locate_sectors([(thing.x, thing.y)
+                                            for thing in things])
+        }
+
         wad_data["map list"].append(map_name)
         wad_data["data"][map_name] = map_data
 
-        # alias for efficient iteration
-        all_skills = {
-            "easy": map_data["easy"],
-            "medium": map_data["medium"],
-            "hard": map_data["hard"]
-            }
-
-        for thing in edit.things:
-
-            # grab the traits of this thing
-            hitscan_counter = count_if(is_hitscanner, thing.type)
-            meaty_counter = count_if(is_meaty, thing.type)
-            health_points = health_points_of(thing.type, options["--bonus"])
-            armor_points = armor_points_of(thing.type, options["--bonus"])
-            shells_inc = shells_of(thing.type)
-            bullets_inc = bullets_of(thing.type)
-            hit_points = hit_points_of(thing.type)
-            attack_points = attack_points_of(thing.type)
-            rockets_inc = rockets_of(thing.type)
-            plasma_inc = plasma_of(thing.type)
-
-            # store traits into skill groups
-            for skill_name, skill in all_skills.items():
-                is_easy = thing.easy and skill_name == "easy"
-                is_medium = thing.medium and skill_name == "medium"
-                is_hard = thing.hard and skill_name == "hard"
-                if is_easy or is_medium or is_hard:
-                    skill["hitscanners"] += hitscan_counter
-                    skill["meaty monsters"] += meaty_counter
-                    skill["health points"] += health_points
-                    skill["armor points"] += armor_points
-                    skill["shells"] += shells_inc
-                    skill["bullets"] += bullets_inc
-                    skill["monster hit points"] += hit_points
-                    skill["monster attack points"] += attack_points
-                    skill["rockets"] += rockets_inc
-                    skill["plasma cells"] += plasma_inc
+    return wad_data
 
-    # sum, calculate & derive answers
-    if len(wad_data["map list"]) > 0:
-        derive_answers(wad_data, options)
-        derive_averages(wad_data, options)
-        format_results(wad_data, options)
 
-    return wad_data
+def find_wad_files(paths):
+    """
+    Expand paths into a sorted list of wad files. Paths can be files,
+    directories (searched recursively for *.wad) or glob patterns.
+    """
+
+    filenames = []
+    for path in paths:
+        if glob.has_magic(path):
+            matches = sorted(glob.glob(path))
+        else:
+            matches = [path]
+        for match in matches:
+            if os.path.isdir(match):
+                for root, dirs, files in os.walk(match):
+                    dirs.sort()
+                    for name in sorted(files):
+                        if name.lower().endswith(".wad"):
+                            filenames.append(os.path.join(root, name))
+            else:
+                filenames.append(match)
+    return filenames
 
 
-def derive_averages(wad_data, options):
+def extract_file_statistics(filename, options):
     """
-    Sum the values from each skill and divide by
-    the number of data points to get an average.
+    Analyse one wad of a batch, with the map pattern from --maps.
+    Returns (filename, wad_data, error), where error describes why the
+    wad could not be read, or is None.
+    """
+
+    file_options = dict(options)
+    file_options["<wad>"] = filename
+    file_options["<pattern>"] = options["--maps"]
+    file_options["--jobs"] = "1"
+
+    if not os.path.isfile(filename):
+        return filename, None, "WAD not found"
+
+    try:
+        if options["--list"]:
+            wad_data = list_maps(file_options)
+        elif options["--sectors"]:
+            wad_data = locate_things(file_options)
+        else:
+            wad_data = extract_statistics(file_options)
+    except Exception as e:
+        return filename, None, str(e) or e.__class__.__name__
+
+    return filename, wad_data, None
+
+
+def extract_batch_statistics(filenames, options):
+    """
+    Analyse a batch of wads, across a pool of --jobs processes.
+    Yields the results of extract_file_statistics in filename order,
+    as soon as each is available.
+    """
+
+    jobs = int(options["--jobs"])
+    if jobs > 1 and len(filenames) > 1:
+        from functools import partial
+        extract = partial(extract_file_statistics, options=options)
+        for result in pool_map(extract, filenames, jobs):
+            yield result
+    else:
+        for filename in filenames:
+            yield extract_file_statistics(filename, options)
+
+
+# map values that are summed and averaged
+AVERAGE_COLUMNS = ("monsters", "hitscanners", "health points",
+                   "armor points", "bullets", "shells", "rockets",
+                   "plasma cells", "monster hit points",
+                   "monster attack points")
+
+
+def new_running_totals():
+    """Return new running totals of map values, for averages."""
+
+    totals = { "maps": 0, "sums": {} }
+    for skill in ("easy", "medium", "hard"):
+        totals["sums"][skill] = dict((col, 0) for col in AVERAGE_COLUMNS)
+    return totals
+
+
+def add_to_totals(totals, map_data):
+    """Add the values of a map to running totals."""
+
+    totals["maps"] += 1
+    for skill, sums in totals["sums"].items():
+        s_data = map_data[skill]
+        for col in AVERAGE_COLUMNS:
+            sums[col] += s_data[col]
+
+
+def averages_of(totals):
+    """
+    Divide running totals by the number of maps to get averages.
+    Returns the sums and averages of each skill, with ratios calculated
+    from the average values.
     """
 
     skill_order = ("easy", "medium", "hard")
-    column_names = ("monsters", "hitscanners", "health points",
-                    "armor points", "bullets", "shells", "rockets",
-                    "plasma cells", "monster hit points",
-                    "monster attack points")
-
-    # Take each stat from each map and compile them into grouped lists.
-    # eg grouped_values["easy"]["shells"] = [10, 20, ...]
-    #    grouped_values["medium"]["shells"] = [30, 10, ...]
-    grouped_values = new_totals_object(column_names)
-    for map_name in wad_data["map list"]:
-        map_data = wad_data["data"][map_name]
-        for skill in skill_order:
-            s_data = map_data[skill]
-            values = grouped_values[skill]
-            for col in column_names:
-                values[col].append(s_data[col])
 
-    # Sum each list into totals and get the average of each sum.
     # eg sums["easy"]["shells"] = 1000
     #     avg["easy"]["shells"] = 25.5
-    sums = new_totals_object(column_names)
-    avg = new_totals_object(column_names)
+    sums = new_totals_object(AVERAGE_COLUMNS)
+    avg = new_totals_object(AVERAGE_COLUMNS)
+    data_points = float(totals["maps"])
     for skill in skill_order:
-        for col in column_names:
-            sums[skill][col] = sum(grouped_values[skill][col])
-            data_points = float(len(grouped_values[skill][col]))
+        for col in AVERAGE_COLUMNS:
+            sums[skill][col] = totals["sums"][skill][col]
             if data_points == 0:
                 avg[skill][col] = 0
             else:
@@ -276,8 +679,20 @@ def derive_averages(wad_data, options):
         avg[skill][constants.ROCKET_DMG_COL] = round(avg_rockets, 2)
         avg[skill][constants.PLASMA_DMG_COL] = round(avg_plasma, 2)
 
-    wad_data["totals"] = sums
-    wad_data["data"]["AVERAGES"] = avg
+    return sums, avg
+
+
+def derive_averages(wad_data, options):
+    """
+    Sum the values from each skill and divide by
+    the number of data points to get an average.
+    """
+
+    totals = new_running_totals()
+    for map_name in wad_data["map list"]:
+        add_to_totals(totals, wad_data["data"][map_name])
+
+    wad_data["totals"], wad_data["data"]["AVERAGES"] = averages_of(totals)
 
 
 def derive_answers(wad_data, options):
@@ -285,13 +700,19 @@ def derive_answers(wad_data, options):
     Look at extracted values to derive statistics.
     """
     for map_name in wad_data["map list"]:
-        map_data = wad_data["data"][map_name]
-        for skill in ["easy", "medium", "hard"]:
-            derive_monster_count(map_data[skill])
-            derive_hitscanner_ratio(map_data[skill])
-            derive_armor_and_health_ratio(map_data[skill])
-            derive_ammo_ratio(map_data[skill])
-            derive_recommendations(map_data, skill, options)
+        derive_map_answers(wad_data["data"][map_name], options)
+
+
+def derive_map_answers(map_data, options):
+    """
+    Look at the extracted values of a map to derive statistics.
+    """
+    for skill in ["easy", "medium", "hard"]:
+        derive_monster_count(map_data[skill])
+        derive_hitscanner_ratio(map_data[skill])
+        derive_armor_and_health_ratio(map_data[skill])
+        derive_ammo_ratio(map_data[skill])
+        derive_recommendations(map_data, skill, options)
 
 
 def format_results(wad_data, options):
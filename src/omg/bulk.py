@@ -0,0 +1,204 @@
+"""
+    Bulk conversion of graphics sections between lumps and image
+    files, spread over a pool of processes.
+
+    Usage as a command:
+
+        python -m omg.bulk export <wad> <directory> [options]
+        python -m omg.bulk import <wad> <directory> -o <output> [options]
+
+    Each section (sprites, patches, flats, graphics by default) has
+    a subdirectory of the directory, with a file per lump.
+"""
+
+import argparse
+import glob
+import io
+import multiprocessing
+import os
+import time
+
+import omg.palette
+from omg.util import *
+from omg.lump import Graphic, Flat
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Palette of a worker process, received once from the parent
+_palette = None
+
+def _init_worker(palette):
+    global _palette
+    _palette = palette
+
+def _run(function, tasks, palette, jobs):
+    """Yield the results of function for each task, in order, using
+    jobs worker processes (or this process if jobs is 1)."""
+    tasks = list(tasks)
+    if jobs <= 1 or len(tasks) <= 1:
+        _init_worker(palette)
+        for task in tasks:
+            yield function(task)
+        return
+    chunksize = max(1, len(tasks) // (jobs * 4))
+    try:
+        from concurrent.futures import ProcessPoolExecutor
+    except ImportError:
+        # Python 2
+        pool = multiprocessing.Pool(jobs, _init_worker, (palette,))
+        try:
+            for result in pool.imap(function, tasks, chunksize):
+                yield result
+        finally:
+            pool.terminate()
+            pool.join()
+        return
+    with ProcessPoolExecutor(jobs, initializer=_init_worker,
+                             initargs=(palette,)) as executor:
+        for result in executor.map(function, tasks, chunksize=chunksize):
+            yield result
+
+def _encode(task):
+    """Convert lump data to the bytes of an image file."""
+    data, flat, format, mode = task
+    if format == 'lmp':
+        return data
+    lump = (Flat if flat else Graphic)(data, palette=_palette)
+    if format == 'raw':
+        return lump.to_raw()
+    output = io.BytesIO()
+    lump.to_Image(mode).save(output,
+                             Image.registered_extensions()['.' + format])
+    return output.getvalue()
+
+def _decode(task):
+    """Convert the bytes of an image file to lump data."""
+    data, format, flat, translate, offsets = task
+    if format in ('lmp', 'raw'):
+        # raw files are only written for flats, whose lumps are raw
+        return data
+    im = Image.open(io.BytesIO(data))
+    if im.mode not in ('P', 'RGB', 'RGBA'):
+        im = im.convert('RGBA')
+    lump = Graphic(palette=_palette)
+    lump.from_Image(im, translate)
+    if flat:
+        return lump.to_raw()
+    if offsets is not None:
+        lump.offsets = offsets
+    return lump.data
+
+def export_graphics(group, directory, palette=None, format='png', mode='P',
+                    jobs=1):
+    """Save the lumps of a graphics section, e.g. wad.sprites, to files
+    named after the lumps in a directory. The format is given as
+    a file extension; 'lmp' saves the lump data and 'raw' the raw
+    pixels (of flats only, other graphics need their size), other
+    formats are saved with PIL in the given mode (see Graphic.to_file).
+
+    Lumps are converted in jobs processes, each receiving the palette
+    once. Files are written in the order of the section. Returns the
+    list of paths written."""
+    palette = palette or omg.palette.default
+    format = format.lower()
+    flat = issubclass(group.lumptype, Flat)
+    if format == 'raw' and not flat:
+        raise ValueError("only flats can be saved as raw pixels")
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    names = list(group.keys())
+    # memory-mapped lumps are views, which can't be sent to workers
+    tasks = ((bytes(group[name].data), flat, format, mode) for name in names)
+    paths = []
+    for name, output in zip(names, _run(_encode, tasks, palette, jobs)):
+        path = os.path.join(directory, "%s.%s" % (name, format))
+        writefile(path, output)
+        paths.append(path)
+    return paths
+
+def import_graphics(group, paths, palette=None, translate=False, jobs=1):
+    """Load image files into a graphics section, e.g. wad.sprites, as
+    lumps named after the files. Files ending in .lmp hold lump data
+    and files ending in .raw the pixels of flats, other images are
+    converted with PIL (see Graphic.from_Image). Images don't hold
+    offsets, so pictures replacing lumps of the section keep the
+    offsets of those lumps, and new pictures get the default offsets
+    of from_Image.
+
+    The files are read by this process and converted in jobs
+    processes, each receiving the palette once. Lumps are added in the
+    order of paths. Returns the list of lump names."""
+    palette = palette or omg.palette.default
+    flat = issubclass(group.lumptype, Flat)
+    formats = [os.path.splitext(p)[1][1:].lower() for p in paths]
+    if 'raw' in formats and not flat:
+        raise ValueError("only flats can be loaded from raw pixels")
+    names = [fixname(os.path.basename(os.path.splitext(p)[0])) for p in paths]
+    offsets = [group[name].offsets
+               if format not in ('lmp', 'raw') and name in group and not flat
+               else None for name, format in zip(names, formats)]
+    tasks = ((readfile(p), format, flat, translate, xy)
+             for p, format, xy in zip(paths, formats, offsets))
+    for name, data in zip(names, _run(_decode, tasks, palette, jobs)):
+        group[name] = group.lumptype(data)
+    return names
+
+def wad_palette(wad):
+    """Return the first palette of a WAD's PLAYPAL lump, or the
+    default palette."""
+    if 'PLAYPAL' in wad.data:
+        return omg.palette.Palette(wad.data['PLAYPAL'].data[:768])
+    return omg.palette.default
+
+def main(args=None):
+    parser = argparse.ArgumentParser(prog='python -m omg.bulk',
+        description="Export or import the graphics of a WAD as image files.")
+    parser.add_argument('command', choices=['export', 'import'])
+    parser.add_argument('wad')
+    parser.add_argument('directory')
+    parser.add_argument('-o', '--output',
+        help="WAD file to write after importing")
+    parser.add_argument('-s', '--sections',
+        default='sprites,patches,flats,graphics',
+        help="comma separated sections [%(default)s]")
+    parser.add_argument('-f', '--format', default='png',
+        help="image file extension to export [%(default)s]")
+    parser.add_argument('-m', '--mode', default='P',
+        help="image mode to export: P, RGB or RGBA [%(default)s]")
+    parser.add_argument('-t', '--translate', action='store_true',
+        help="translate the colors of imported paletted images")
+    parser.add_argument('-j', '--jobs', type=int, default=multiprocessing.cpu_count(),
+        help="number of processes [%(default)s]")
+    options = parser.parse_args(args)
+    if options.command == 'import' and not options.output:
+        parser.error("import needs an --output WAD")
+    if options.command == 'export' and options.format.lower() == 'raw' \
+       and options.sections != 'flats':
+        parser.error("only flats can be saved as raw pixels, "
+                     "use --sections flats")
+
+    wad = omg.WAD(options.wad)
+    palette = wad_palette(wad)
+    for section in options.sections.split(','):
+        group = wad.__dict__[section]
+        directory = os.path.join(options.directory, section)
+        start = time.time()
+        if options.command == 'export':
+            count = len(export_graphics(group, directory, palette,
+                                        options.format, options.mode,
+                                        options.jobs))
+        else:
+            paths = sorted(glob.glob(os.path.join(directory, '*.*')))
+            count = len(import_graphics(group, paths, palette,
+                                        options.translate, options.jobs))
+        elapsed = time.time() - start
+        print("%s: %d lumps in %.2fs (%.0f lumps/sec)" % (section, count,
+              elapsed, count / elapsed if elapsed > 0 else 0))
+    if options.command == 'import':
+        wad.to_file(options.output)
+
+if __name__ == '__main__':
+    main()
@@ -19,14 +19,18 @@ class Colormap:
         this may be overriden. Light color is not yet supported."""
         palette = palette or omg.palette.default
         x, y, z = fade
+        # look up the colors of all tables at once
+        colors = bytearray()
         for n in range(32):
             e = 31-n
             for c in range(256):
                 r, g, b = palette.colors[c]
-                r = (r*n + x*e) // 32
-                g = (g*n + y*e) // 32
-                b = (b*n + z*e) // 32
-                self.tables[e][c] = palette.match((r,g,b))
+                colors.append((r*n + x*e) // 32)
+                colors.append((g*n + y*e) // 32)
+                colors.append((b*n + z*e) // 32)
+        indices, _ = palette.match_many(bytes(colors), 'RGB')
+        for n in range(32):
+            self.tables[31-n] = list(six.iterbytes(indices[n*256:(n+1)*256]))
 
     def build_invuln(self, palette=None, start=(0,0,0), end=(255,255,255)):
         """Build range used by the invulnerability powerup."""
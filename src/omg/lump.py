@@ -27,11 +27,17 @@ class Lump(object):
         .data       -- a bytes object holding the lump's data
         .from_file  -- load the data to a file
         .to_file    -- save the data to a file
+        .from_wadio -- load the data from an entry of a WadIO object,
+                       optionally deferring the read until first access
 
     The default Lump class merely copies the raw data when
     loading/saving to files, but subclasses may convert data
     appropriately (for example, Graphic supports various image
-    formats)."""
+    formats).
+
+    The data of lumps read from a memory-mapped WadIO object is a
+    read-only memoryview into the file rather than a bytes object.
+    Methods that modify a lump replace it with a new bytes object."""
 
     def __init__(self, data=None, from_file=None):
         """Create a new instance. The `data` parameter may be a string
@@ -45,6 +51,29 @@ class Lump(object):
         if from_file:
             self.from_file(from_file)
 
+    def get_data(self):
+        """Retrieve the lump's data, reading it from the bound WadIO
+        object first if needed."""
+        if self._data is None:
+            wadio, ptr, size = self._source
+            self._data = wadio.read_at(ptr, size)
+        return self._data
+
+    def set_data(self, data):
+        """Replace the lump's data. This unbinds a lazily loaded lump
+        from its WadIO object."""
+        self._data = data
+        self._source = None
+
+    data = property(get_data, set_data)
+
+    def data_size(self):
+        """Return the size of the lump's data, without reading it
+        from the bound WadIO object of a lazily loaded lump."""
+        if self._data is None:
+            return self._source[2]
+        return len(self._data)
+
     def from_file(self, source):
         """Load data from a file. Source may be a path name string
         or a file-like object (with a `write` method)."""
@@ -55,9 +84,44 @@ class Lump(object):
         or a file-like object (with a `write` method)."""
         writefile(target, self.data)
 
+    def from_wadio(self, wadio, id, lazy=False):
+        """Load data from an entry (index or name) of a WadIO object.
+
+        If lazy is true, only the position and size of the entry are
+        stored and the data is read on first access. The WadIO object
+        must stay open for as long as the lump is in use, and changes
+        to the entry made afterwards are not picked up."""
+        if lazy:
+            entry = wadio.get(id)
+            self._data = None
+            self._source = (wadio, entry.ptr, entry.size)
+        else:
+            self.data = wadio.read(id)
+
+    def unload(self):
+        """Drop the data of a lazily loaded lump. It is read again
+        from the WadIO object on next access. Has no effect on lumps
+        that are not bound to a WadIO object."""
+        if self._source is not None:
+            self._data = None
+
     def copy(self):
         return deepcopy(self)
 
+    def __deepcopy__(self, memo):
+        # The WadIO object of a lazily loaded lump is shared, not copied
+        c = self.__class__.__new__(self.__class__)
+        memo[id(self)] = c
+        for key, value in self.__dict__.items():
+            if key == "_source":
+                c.__dict__[key] = value
+            elif isinstance(value, memoryview):
+                # buffers into a memory-mapped file are copied as bytes
+                c.__dict__[key] = value.tobytes()
+            else:
+                c.__dict__[key] = deepcopy(value, memo)
+        return c
+
 
 class Music(Lump):
     """Subclass of Lump, for music lumps. Not yet implemented."""
@@ -163,10 +227,10 @@ class Sound(Lump):
 
         if format == 2:
             # single MIDI note
-            self.data = self.data[:8] + pack('<H', length)
+            self.data = join([self.data[:8], pack('<H', length)])
         else:
             # grow or shrink existing raw data to new size
-            self.from_raw(self.to_raw()[0:length] + b'\0'*(length - self.length))
+            self.from_raw(join([self.to_raw()[0:length], b'\0'*(length - self.length)]))
     
     length = property(get_length, set_length)
     
@@ -188,7 +252,7 @@ class Sound(Lump):
         format = self.format
         if format == 3:
             # digitized sound
-            self.data = self.data[:2] + pack('<H', sample_rate) + self.data[4:]
+            self.data = join([self.data[:2], pack('<H', sample_rate), self.data[4:]])
         else:
             raise TypeError("set_sample_rate only supported for digitized sounds (format 3)")
             
@@ -209,10 +273,10 @@ class Sound(Lump):
         format = self.format
         if format == 1:
             # MIDI sequence
-            self.data = self.data[:4] + pack('<H', bank) + self.data[6:]
+            self.data = join([self.data[:4], pack('<H', bank), self.data[6:]])
         elif format == 2:
             # single MIDI note
-            self.data = self.data[:2] + pack('<H', bank) + self.data[4:]
+            self.data = join([self.data[:2], pack('<H', bank), self.data[4:]])
         else:
             raise TypeError("only supported for MIDI sounds (format 1 or 2)")
     
@@ -233,10 +297,10 @@ class Sound(Lump):
         format = self.format
         if format == 1:
             # MIDI sequence
-            self.data = self.data[:6] + pack('<H', patch) + self.data[8:]
+            self.data = join([self.data[:6], pack('<H', patch), self.data[8:]])
         elif format == 2:
             # single MIDI note
-            self.data = self.data[:4] + pack('<H', patch) + self.data[6:]
+            self.data = join([self.data[:4], pack('<H', patch), self.data[6:]])
         else:
             raise TypeError("only supported for MIDI sounds (format 1 or 2)")
     
@@ -266,17 +330,17 @@ class Sound(Lump):
         
         if format == 0:
             # PC speaker sound
-            self.data = self.data[:2] + pack('<H', len(data)) + data
+            self.data = join([self.data[:2], pack('<H', len(data)), data])
         elif format == 1:
             # MIDI sequence
-            self.data = self.data[:2] + pack('<H', len(data)) + self.data[4:8] + data
+            self.data = join([self.data[:2], pack('<H', len(data)), self.data[4:8], data])
         elif format == 2:
             # single MIDI note
-            self.data = self.data[:6] + pack('<H', data) + self.data[8:]
+            self.data = join([self.data[:6], pack('<H', data), self.data[8:]])
         elif format == 3:
             # digitized sound
-            self.data = self.data[:4] + pack('<I', 32 + len(data)) \
-                        + b'\0'*16 + data + b'\0'*16
+            self.data = join([self.data[:4], pack('<I', 32 + len(data)),
+                              b'\0'*16, data, b'\0'*16])
             if sample_rate is not None:
                 self.sample_rate = sample_rate
         else:
@@ -372,7 +436,7 @@ class Graphic(Lump):
 
     def set_offsets(self, xy):
         """Set the (x, y) offsets of the graphic."""
-        self.data = self.data[:4] + pack('<hh', *xy) + self.data[8:]
+        self.data = join([self.data[:4], pack('<hh', *xy), self.data[8:]])
 
     def get_dimensions(self):
         """Retrieve the (width, height) dimensions of the graphic."""
@@ -391,101 +455,85 @@ class Graphic(Lump):
     def from_pixels(self, data, width, height, x_offset=0, y_offset=0):
         """Load a list of 8bpp pixels.
         Pixels with value None are transparent."""
+        data = data[:width*height]
+        pixels = bytearray([0 if p is None else p for p in data])
+        mask = bytearray([0 if p is None else 1 for p in data])
+        self.from_indexed(pixels, mask, width, height, x_offset, y_offset)
+
+    def from_indexed(self, pixels, mask, width, height, x_offset=0, y_offset=0):
+        """Load 8bpp pixels from a bytes-like object, with a mask of the
+        same size in which zero bytes mark transparent pixels."""
         
         if min(width, height) < 0 or max(width, height) > 32767:
             raise ValueError("image width and height must be between 0-32767")
         
-        # First pass: extract pixel data in column+post format
-        columns_in = [data[n:width*height:width] for n in range(width)]
-        columns_out = []
-        for column in columns_in:
-            # Find the y position where each chunk starts
-            start_rows = []
-            postdata = []
-            in_trans = True
-            tall = False
-            offset = 0
-            for y in range(height):
-                # split at 128 for vanilla-compatible images without premature tiling
-                if height < 256: 
-                    if y == 128:
-                        in_trans = True
-            
-                # for tall patch support
-                elif offset == 254:
-                    in_trans = True
-                    tall = True
-                    # dummy post
-                    start_rows.append(254)
-                    postdata.append(bytearray())
-                    # start relative offsets
-                    offset = 0
-            
-                if column[y] is None:
-                    in_trans = True
-                else:
-                    if in_trans:
-                        # start a new post
-                        start_rows.append(offset)
-                        postdata.append(bytearray())
-                        in_trans = False
-                        if tall:
-                            # reset relative offset for tall patches
-                            offset = 0
-                    postdata[-1].append(column[y])
-                
-                offset += 1
-            columns_out.append(zip(start_rows, postdata))
-        # Second pass: compile column+post data, adding pointers
+        size = width*height
+        pixels = bytes(pixels[:size])
+        mask = bytes(mask[:size]).translate(_opaque_mask)
         data = []
         columnptrs = []
         pointer = 4*width + 8
-        for column in columns_out:
+        for x in range(width):
             columnptrs.append(pack('<i', pointer))
-            for row, pixels in column:
-                data.append(b"%c%c\x00%s\x00" % (row, len(pixels), pixels))
-                pointer += 4 + len(pixels)
+            column = pixels[x:size:width]
+            opaque = mask[x:size:width]
+            for row, start, stop in _column_posts(opaque, height):
+                data.append(pack('BBB', row, stop - start, 0))
+                data.append(column[start:stop])
+                data.append(b'\x00')
+                pointer += 4 + stop - start
             data.append(b'\xff')
             pointer += 1
         # Merge everything together
-        self.data = bytes().join([pack('4h', width, height, x_offset, y_offset),
-                    bytes().join(columnptrs), bytes().join(data)])
+        self.data = bytes().join([pack('4h', width, height, x_offset, y_offset)]
+                                 + columnptrs + data)
 
     def from_raw(self, data, width, height, x_offset=0, y_offset=0, pal=None):
         """Load a raw 8-bpp image, converting to the Doom picture format
         (used by all graphics except flats)"""
         pal = pal or omg.palette.default
-        pixels = [i if i != pal.tran_index else None for i in six.iterbytes(data)]
-        self.from_pixels(pixels, width, height, x_offset, y_offset)
-
-    def to_pixels(self):
-        """Returns self converted to a list of 8bpp pixels.
-        Pixels with value None are transparent."""
-        data = self.data
+        table = bytearray([1]) * 256
+        table[pal.tran_index] = 0
+        mask = bytes(data).translate(bytes(table))
+        self.from_indexed(data, mask, width, height, x_offset, y_offset)
+
+    def to_indexed(self, fill=0):
+        """Returns self converted to a pair of bytearrays: the 8bpp
+        pixels, and a mask which is 1 for opaque and 0 for transparent
+        pixels. Transparent pixels have the value `fill`."""
+        data = bytearray(self.data)
         width, height = self.dimensions
-        output = [None] * (width*height)
-        pointers = unpack('<%il'%width, data[8 : 8 + width*4])
+        size = width*height
+        pixels = bytearray([fill]) * size
+        mask = bytearray(size)
+        opaque = bytearray([1]) * height
+        pointers = unpack('<%il'%width, self.data[8 : 8 + width*4])
         for x in range(width):
             y = -1
             pointer = pointers[x]
-            if pointer >= len(data):
-                continue
-
-            while six.indexbytes(data, pointer) != 0xff:
-                offset = six.indexbytes(data, pointer)
+            while pointer < len(data) and data[pointer] != 0xff:
+                offset = data[pointer]
                 if offset <= y:
                     y += offset # for tall patches
                 else:
-                    y = offset				
-                post_length = six.indexbytes(data, pointer+1)
-                op = y*width + x
-                for p in range(pointer + 3, pointer + post_length + 3):
-                    if op >= len(output) or p >= len(data):
-                        break
-                    output[op] = six.indexbytes(data, p)
-                    op += width
+                    y = offset
+                post_length = data[pointer+1]
+                # clip posts to the image and to the lump
+                post = data[pointer + 3 :
+                            pointer + 3 + max(0, min(post_length, height - y))]
+                if post:
+                    start = y*width + x
+                    stop = start + len(post)*width
+                    pixels[start:stop:width] = post
+                    mask[start:stop:width] = opaque[:len(post)]
                 pointer += post_length + 4
-        return output
+        return pixels, mask
+
+    def to_pixels(self):
+        """Returns self converted to a list of 8bpp pixels.
+        Pixels with value None are transparent."""
+        pixels, mask = self.to_indexed()
+        return [p if m else None for p, m in zip(pixels, mask)]
         
     def to_raw(self, tran_index=None):
         """Returns self converted to a raw (8-bpp) image.
@@ -494,8 +542,7 @@ class Graphic(Lump):
         transparent pixels. The value defaults to that of the
         Graphic object's palette instance."""
         tran_index = tran_index or self.palette.tran_index
-        output = [i if i is not None else tran_index for i in self.to_pixels()]
-        return bytes(bytearray(output))
+        return bytes(self.to_indexed(tran_index)[0])
 
     def to_Image(self, mode='P'):
         """Convert to a PIL Image instance"""
@@ -511,10 +558,15 @@ class Graphic(Lump):
             return im.convert(mode)
         else:
             # target image is RGBA and source image is not a flat
-            im = Image.new('RGBA', self.dimensions, None)
-            data = bytes().join([self.palette.bytes[i*3:i*3+3] + b'\xff' if i is not None \
-                                 else b'\0\0\0\0' for i in self.to_pixels()])
-            im.frombytes(data)
+            pixels, mask = self.to_indexed()
+            colors = Image.new('P', self.dimensions, None)
+            colors.frombytes(bytes(pixels))
+            colors.putpalette(self.palette.bytes)
+            alpha = Image.new('L', self.dimensions, None)
+            alpha.frombytes(bytes(mask.translate(_mask_to_alpha)))
+            # transparent pixels stay (0, 0, 0, 0)
+            im = Image.new('RGBA', self.dimensions, (0, 0, 0, 0))
+            im.paste(colors.convert('RGBA'), (0, 0), alpha)
             return im
 
     def from_Image(self, im, translate=False):
@@ -531,16 +583,14 @@ class Graphic(Lump):
         width, height = im.size
         xoff, yoff = (width // 2)-1, height-5
         if im.mode == "RGB":
-            pixels = join([six.int2byte(self.palette.match(unpack('BBB', \
-                pixels[i*3:(i+1)*3]))) for i in range(width*height)])
+            pixels, mask = self.palette.match_many(pixels, "RGB")
 
             self.from_raw(pixels, width, height, xoff, yoff, self.palette)
         
         elif im.mode == "RGBA":
-            pixels = [unpack('BBBB', pixels[i*4:(i+1)*4]) for i in range(width*height)]
-            pixels = [self.palette.match(i[0:3]) if i[3] > 0 else None for i in pixels]
+            pixels, mask = self.palette.match_many(pixels, "RGBA")
             
-            self.from_pixels(pixels, width, height, xoff, yoff)
+            self.from_indexed(pixels, mask, width, height, xoff, yoff)
     
         elif im.mode == 'P':
             srcpal = im.palette.tobytes()
@@ -552,12 +602,12 @@ class Graphic(Lump):
                 raise TypeError("palette mode must be 'RGB' or 'RGBA'")
             
             if translate:
-                R = [c for c in six.iterbytes(srcpal[0::palsize])]
-                G = [c for c in six.iterbytes(srcpal[1::palsize])]
-                B = [c for c in six.iterbytes(srcpal[2::palsize])]
-
-                srcpal = zip(R, G, B)
-                lexicon = [six.int2byte(self.palette.match(c)) for c in srcpal]
+                srcpal = bytearray(srcpal)
+                if palsize == 4:
+                    # ignore alpha
+                    del srcpal[3::4]
+                lexicon, _ = self.palette.match_many(bytes(srcpal), "RGB")
+                lexicon = [six.int2byte(i) for i in six.iterbytes(lexicon)]
                 pixels = join([lexicon[b] for b in six.iterbytes(pixels)])
             else:
                 # Simply copy pixels. However, make sure to translate
@@ -611,17 +661,71 @@ class Graphic(Lump):
 
     def translate(self, pal):
         """Translate (in-place) the graphic to another palette."""
-        lexicon = [six.int2byte(pal.match(self.palette.colors[i])) for i in range(256)]
+        lexicon, _ = pal.match_many(self.palette.bytes, "RGB")
+        lexicon = [six.int2byte(i) for i in six.iterbytes(lexicon)]
         lexicon[self.palette.tran_index] = six.int2byte(pal.tran_index)
         if isinstance(self, Flat):
-            self.data = join([lexicon[b] for b in self.data])
+            self.data = join([lexicon[b] for b in six.iterbytes(self.data)])
         else:
             raw = self.to_raw()
-            #raw = raw.replace(six.int2byte(self.palette.tran_index), six.int2byte(pal.tran_index))
-            self.load_raw(join([lexicon[b] for b in raw]),
+            self.from_raw(join([lexicon[b] for b in six.iterbytes(raw)]),
                 self.width, self.height,
-                self.x_offset, self.y_offset)
-
+                self.x_offset, self.y_offset, pal)
+
+
+def _column_posts(opaque, height):
+    """Yield the (row, start, stop) posts of a column, from a mask of
+    its opaque pixels as 0 and 1 bytes. `row` is the offset stored
+    in the post, `start` and `stop` the range of pixels in it."""
+    runs = []
+    stop = 0
+    while True:
+        start = opaque.find(b'\x01', stop)
+        if start < 0:
+            break
+        stop = opaque.find(b'\x00', start)
+        if stop < 0:
+            stop = len(opaque)
+        runs.append((start, stop))
+    if height < 256:
+        # split at 128 for vanilla-compatible images without
+        # premature tiling
+        for start, stop in runs:
+            if start < 128 < stop:
+                yield start, start, 128
+                start = 128
+            yield start, start, stop
+        return
+    # Tall patches: every 254 rows without a new post, a dummy post
+    # with offset 254 moves the base row. Once one is added, post
+    # offsets are relative to the previous post.
+    base = 0
+    tall = False
+    for start, stop in runs:
+        while base + 254 <= start:
+            base += 254
+            tall = True
+            yield 254, base, base
+        row = start - base
+        if tall:
+            base = start
+        while base + 254 < stop:
+            # split long posts
+            yield row, start, base + 254
+            base = start = base + 254
+            tall = True
+            yield 254, start, start
+            row = 0
+        yield row, start, stop
+    while base + 254 < height:
+        base += 254
+        yield 254, base, base
+
+# Translation of masks to 0 and 1 bytes
+_opaque_mask = bytes(bytearray([0] + [1] * 255))
+
+# Translation of opaque masks to image alpha
+_mask_to_alpha = bytes(bytearray([0, 255] + [0] * 254))
 
 class Flat(Graphic):
     """Subclass of Graphic, for flat graphics"""
@@ -643,5 +747,9 @@ class Flat(Graphic):
     def load_raw(self, data, *unused):
         self.data = data
 
+    def to_indexed(self, fill=0):
+        # flats have no transparent pixels
+        return bytearray(self.data), bytearray([1]) * len(self.data)
+
     def to_raw(self):
         return self.data
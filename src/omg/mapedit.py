@@ -1,10 +1,20 @@
 from omg.util import *
 from omg.lump import *
 from omg.wad import NameGroup
+from omg.spatial import SpatialIndex
 
 import omg.lineinfo as lineinfo
 import omg.thinginfo as thinginfo
 
+from array import array
+
+# ArrayMap keeps map lumps in NumPy structured arrays if NumPy is
+# available, otherwise in columns of the array module.
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 Vertex = make_struct(
   "Vertex", """Represents a map vertex""",
   [["x", "h", 0],
@@ -145,6 +155,15 @@ GLSeg = make_struct(
    ["partner", 'H', 0]]
 )
 
+def _on_left_side(x, y, x_start, y_start, dx, dy):
+    """Test which side of a node partition line a point is on, the
+    way Doom does. The right side is the front."""
+    if dx == 0:
+        return dy > 0 if x <= x_start else dy < 0
+    if dy == 0:
+        return dx < 0 if y <= y_start else dx > 0
+    return (y - y_start) * dx >= dy * (x - x_start)
+
 class MapEditor:
     """Doom map editor
 
@@ -172,10 +191,20 @@ class MapEditor:
         reject        Lump object containing reject table data
         (These five lumps are not updated when saving; you will need to use
         an external node builder utility)
+
+    The lists are decoded from their lumps on first access. Lumps whose
+    list was never accessed are saved unchanged by to_lumps.
         """
 
+    # lists decoded on first access, with their lumps
+    _list_lumps = [("vertexes", "VERTEXES"), ("sidedefs", "SIDEDEFS"),
+                   ("sectors",  "SECTORS"),  ("things",   "THINGS"),
+                   ("linedefs", "LINEDEFS"), ("ssectors", "SSECTORS"),
+                   ("segs",     "SEGS"),     ("nodes",    "NODES")]
+
     def __init__(self, from_lumps=None):
         """Create new, optionally from a lump group"""
+        self._raw = {}
         if from_lumps is not None:
             self.from_lumps(from_lumps)
         else:
@@ -195,19 +224,46 @@ class MapEditor:
             self.reject   = Lump("")
 
     def _unpack_lump(self, class_, data):
-        s = class_._fmtsize
-        return [class_(bytes=data[i:i+s]) for i in range(0,len(data),s)]
+        return class_.unpack_many(data)
+
+    def __getattr__(self, name):
+        # decode a list from its lump on first access
+        raw = self.__dict__.get("_raw")
+        if raw is None or name not in raw:
+            raise AttributeError(name)
+        class_, lump = raw.pop(name)
+        value = self._unpack_lump(class_, lump.data)
+        if name == "linedefs":
+            # use -1 for unused sidedefs instead of 0xFFFF
+            for line in value:
+                if line.front == 0xFFFF: line.front = -1
+                if line.back  == 0xFFFF: line.back  = -1
+        setattr(self, name, value)
+        return value
+
+    def __setattr__(self, name, value):
+        # an assigned list replaces the lump it would be decoded from
+        raw = self.__dict__.get("_raw")
+        if raw:
+            raw.pop(name, None)
+        self.__dict__[name] = value
 
     def from_lumps(self, lumpgroup):
-        """Load entries from a lump group."""
+        """Load entries from a lump group. The entries of each lump
+        are decoded on first access."""
         m = lumpgroup
         
+        # forget lists of a previously loaded map
+        self._raw = {}
+        for name, _ in self._list_lumps:
+            self.__dict__.pop(name, None)
+        
         try:
             self.header   = m["_HEADER_"]
             
-            self.vertexes = self._unpack_lump(Vertex,    m["VERTEXES"].data)
-            self.sidedefs = self._unpack_lump(Sidedef,   m["SIDEDEFS"].data)
-            self.sectors  = self._unpack_lump(Sector,    m["SECTORS"].data)
+            self._raw["vertexes"] = (Vertex,  m["VERTEXES"])
+            self._raw["sidedefs"] = (Sidedef, m["SIDEDEFS"])
+            self._raw["sectors"]  = (Sector,  m["SECTORS"])
             
             if "BEHAVIOR" in m:
                 # Hexen / ZDoom map
@@ -228,26 +284,26 @@ class MapEditor:
                 except AttributeError:
                     pass
             
-            self.things   = self._unpack_lump(self.Thing,   m["THINGS"].data)
-            self.linedefs = self._unpack_lump(self.Linedef, m["LINEDEFS"].data)
+            self._raw["things"]   = (self.Thing,   m["THINGS"])
+            self._raw["linedefs"] = (self.Linedef, m["LINEDEFS"])
         except KeyError as e:
             raise ValueError("map is missing %s lump" % e)
         
-        # use -1 for unused sidedefs instead of 0xFFFF
-        for line in self.linedefs:
-            if line.front == 0xFFFF: line.front = -1
-            if line.back  == 0xFFFF: line.back  = -1
-        
-        from struct import error as StructError
         try:
-            self.ssectors = self._unpack_lump(SubSector, m["SSECTORS"].data)
-            self.segs     = self._unpack_lump(Seg,       m["SEGS"].data)
-            self.nodes    = self._unpack_lump(Node,      m["NODES"].data)
+            node_lumps = [("ssectors", SubSector, m["SSECTORS"]),
+                          ("segs",     Seg,       m["SEGS"]),
+                          ("nodes",    Node,      m["NODES"])]
             self.blockmap = m["BLOCKMAP"]
             self.reject   = m["REJECT"]
-        except (KeyError, StructError):
+            for name, class_, lump in node_lumps:
+                if lump.data_size() % class_._fmtsize:
+                    raise ValueError
+                self._raw[name] = (class_, lump)
+        except (KeyError, ValueError):
             # nodes failed to build - we don't really care
             # TODO: this also "handles" (read: ignores) expanded zdoom nodes)
+            for name in ("ssectors", "segs", "nodes"):
+                self._raw.pop(name, None)
             self.ssectors = []
             self.segs     = []
             self.nodes    = []
@@ -261,24 +317,36 @@ class MapEditor:
         self.gl_segs  = self._unpack_lump(GLSeg,     mapobj["GL_SEGS"].data)
         self.gl_ssect = self._unpack_lump(SubSector, mapobj["GL_SSECT"].data)
 
+    def _pack_lump(self, name, class_):
+        # lumps of lists that were never decoded are passed through
+        if name in self._raw:
+            return self._raw[name][1]
+        objs = getattr(self, name)
+        if name == "linedefs":
+            # change -1 to 0xFFFF so linedefs pack correctly
+            # (on copies, the editor keeps using -1)
+            linedefs = []
+            for line in objs:
+                if line.front == -1 or line.back == -1:
+                    line = copy(line)
+                    if line.front == -1: line.front = 0xFFFF
+                    if line.back  == -1: line.back  = 0xFFFF
+                linedefs.append(line)
+            objs = linedefs
+        return Lump(class_.pack_many(objs))
+
     def to_lumps(self):
         m = NameGroup()
         
-        # change -1 to 0xFFFF so linedefs pack correctly
-        linedefs = self.linedefs[:]
-        for line in linedefs:
-            if line.front == -1: line.front = 0xFFFF
-            if line.back  == -1: line.back  = 0xFFFF
-        
         m["_HEADER_"] = self.header
-        m["VERTEXES"] = Lump(join([x.pack() for x in self.vertexes]))
-        m["THINGS"  ] = Lump(join([x.pack() for x in self.things  ]))
-        m["LINEDEFS"] = Lump(join([x.pack() for x in linedefs     ]))
-        m["SIDEDEFS"] = Lump(join([x.pack() for x in self.sidedefs]))
-        m["SECTORS" ] = Lump(join([x.pack() for x in self.sectors ]))
-        m["NODES"]    = Lump(join([x.pack() for x in self.nodes   ]))
-        m["SEGS"]     = Lump(join([x.pack() for x in self.segs    ]))
-        m["SSECTORS"] = Lump(join([x.pack() for x in self.ssectors]))
+        m["VERTEXES"] = self._pack_lump("vertexes", Vertex)
+        m["THINGS"  ] = self._pack_lump("things",   self.Thing)
+        m["LINEDEFS"] = self._pack_lump("linedefs", self.Linedef)
+        m["SIDEDEFS"] = self._pack_lump("sidedefs", Sidedef)
+        m["SECTORS" ] = self._pack_lump("sectors",  Sector)
+        m["NODES"]    = self._pack_lump("nodes",    Node)
+        m["SEGS"]     = self._pack_lump("segs",     Seg)
+        m["SSECTORS"] = self._pack_lump("ssectors", SubSector)
         m["BLOCKMAP"] = self.blockmap
         m["REJECT"]   = self.reject
         
@@ -294,8 +362,15 @@ class MapEditor:
     def draw_sector(self, vertexes, sector=None, sidedef=None):
         """Draw a polygon from a list of vertexes. The vertexes may be
         either Vertex objects or simple (x, y) tuples. A sector object
-        and prototype sidedef may be provided."""
+        and prototype sidedef may be provided.
+
+        Edges are merged by looking up the positions of their ends in
+        an index of the linedefs (see reindex). Linedefs found in the
+        index are checked, so edits in place never merge the wrong
+        linedefs, but edges moved onto the new ones are only merged
+        after reindex()."""
         assert len(vertexes) > 2
+        self._edge_index()
         firstv = len(self.vertexes)
         firsts = len(self.sidedefs)
         if sector  is None: sector  = Sector()
@@ -313,27 +388,154 @@ class MapEditor:
             self.sidedefs.append(side)
             
             #check if the new line is being written over an existing
-            #and merge them if so.
+            #and merge them if so (looked up by vertex positions).
             new_linedef = Linedef(vx_a=firstv+((i+1)%len(vertexes)),
                                   vx_b=firstv+i, front=firsts+i, flags=1)
-            match_existing = False
-            for lc in self.linedefs:
-                if (self.compare_linedefs(new_linedef,lc) > 0):
-                    #remove midtexture and apply it to the upper/lower
-                    side.tx_low = self.sidedefs[lc.front].tx_mid
-                    side.tx_up = self.sidedefs[lc.front].tx_mid
-                    self.sidedefs[lc.front].tx_low = side.tx_mid
-                    self.sidedefs[lc.front].tx_up = side.tx_mid
-                    side.tx_mid = "-"
-                    self.sidedefs[lc.front].tx_mid = "-"
-                    lc.back = len(self.sidedefs)-1
-                    match_existing = True
-                    lc.two_sided = True
-                    lc.impassable = False
-                    break
-            if (match_existing == False):
+            key = self._edge_key(new_linedef)
+            matches = self._find_edge(key)
+            if matches:
+                lc = self.linedefs[matches[0]]
+                #remove midtexture and apply it to the upper/lower
+                side.tx_low = self.sidedefs[lc.front].tx_mid
+                side.tx_up = self.sidedefs[lc.front].tx_mid
+                self.sidedefs[lc.front].tx_low = side.tx_mid
+                self.sidedefs[lc.front].tx_up = side.tx_mid
+                side.tx_mid = "-"
+                self.sidedefs[lc.front].tx_mid = "-"
+                lc.back = len(self.sidedefs)-1
+                lc.two_sided = True
+                lc.impassable = False
+            else:
                 self.linedefs.append(new_linedef)
+                self._edges.setdefault(key, []).append(len(self.linedefs)-1)
+        self._edges_state = self._list_state()
     
+    def _list_state(self):
+        return (id(self.vertexes), len(self.vertexes),
+                id(self.linedefs), len(self.linedefs))
+
+    def _edge_key(self, linedef):
+        """Return the positions of the ends of a linedef, in sorted
+        order, or None if it refers to missing vertexes."""
+        try:
+            a = self.vertexes[linedef.vx_a]
+            b = self.vertexes[linedef.vx_b]
+        except IndexError:
+            return None
+        a, b = (a.x, a.y), (b.x, b.y)
+        return (a, b) if a <= b else (b, a)
+
+    def _index_linedefs(self, start):
+        """Add linedefs from index start on to the edge index."""
+        edges = self._edges
+        for i in range(start, len(self.linedefs)):
+            key = self._edge_key(self.linedefs[i])
+            if key is not None:
+                edges.setdefault(key, []).append(i)
+        self._edges_state = self._list_state()
+
+    def _edge_index(self):
+        """Return the edge index, rebuilding it if the vertex or
+        linedef lists were changed since it was built."""
+        if self.__dict__.get("_edges_state") != self._list_state():
+            self.reindex()
+        return self._edges
+
+    def _find_edge(self, key):
+        """Return the indexes of the linedefs between the positions in
+        key, rebuilding the edge index if it is found to be stale."""
+        matches = self._edge_index().get(key)
+        if matches and self._edge_key(self.linedefs[matches[0]]) != key:
+            # vertexes or linedefs were changed in place
+            self.reindex()
+            matches = self._edges.get(key)
+        return matches
+
+    def reindex(self):
+        """Rebuild the index of linedefs by the positions of their
+        vertexes, used by draw_sector and find_linedef. Only the
+        lengths and identities of the vertex and linedef lists are
+        checked, so appending, removing and assigning new lists are
+        detected, but not moving vertexes, changing the vertexes of
+        linedefs, or replacing items or slices without changing the
+        lengths of the lists. Linedefs found through a stale index
+        are checked and the index rebuilt, but linedefs moved onto an
+        edge are only found after calling this method."""
+        self._edges = {}
+        self._index_linedefs(0)
+
+    def find_linedef(self, vertex1, vertex2):
+        """Find a linedef between the positions of two vertexes, in
+        either direction. The vertexes may be either Vertex objects or
+        simple (x, y) tuples. Returns the index of the first such
+        linedef, or None.
+
+        Call reindex() first if vertexes were moved or linedefs were
+        changed in place since the last draw_sector, paste or
+        find_linedef, to find linedefs that were moved there."""
+        a = vertex1 if isinstance(vertex1, tuple) else (vertex1.x, vertex1.y)
+        b = vertex2 if isinstance(vertex2, tuple) else (vertex2.x, vertex2.y)
+        key = (a, b) if a <= b else (b, a)
+        matches = self._find_edge(key)
+        if matches:
+            return matches[0]
+        return None
+
+    def locate_sectors(self, points):
+        """Find the sectors containing a sequence of (x, y) points,
+        such as the positions of things. Returns a list with the index
+        of the sector of each point.
+
+        The points are located by walking the BSP tree from the NODES,
+        SSECTORS and SEGS lumps, as the game does, so points outside
+        the map get the sector of a nearby subsector. If the nodes are
+        missing or broken, a grid of the linedefs is searched instead,
+        and points outside the map get -1."""
+        tree = self._bsp_tree()
+        if tree is None:
+            return SpatialIndex.from_map(self).locate_sectors(points)
+        nodes, ssector_sectors = tree
+        found = []
+        for x, y in points:
+            child = len(nodes) - 1
+            if child < 0:
+                # a map with a single subsector has no nodes
+                child = 0x8000
+            while not child & 0x8000:
+                x_start, y_start, dx, dy, right, left = nodes[child]
+                child = left if _on_left_side(x, y, x_start, y_start,
+                                              dx, dy) else right
+            found.append(ssector_sectors[child & 0x7FFF])
+        return found
+
+    def _bsp_tree(self):
+        """Return the nodes as tuples and the sector of each subsector,
+        or None if they can't be used to locate points."""
+        nodes = [(n.x_start, n.y_start, n.x_vector, n.y_vector,
+                  n.right_index, n.left_index) for n in self.nodes]
+        ssector_sectors = []
+        try:
+            for ssector in self.ssectors:
+                seg = self.segs[ssector.seg_a]
+                linedef = self.linedefs[seg.line]
+                sidedef = linedef.back if seg.side else linedef.front
+                if sidedef < 0:
+                    return None
+                ssector_sectors.append(self.sidedefs[sidedef].sector)
+        except IndexError:
+            return None
+        if not ssector_sectors or (not nodes and len(ssector_sectors) > 1):
+            return None
+        # children must come before their parents, so walks end
+        for i, node in enumerate(nodes):
+            for child in node[4:]:
+                if child & 0x8000:
+                    if child & 0x7FFF >= len(ssector_sectors):
+                        return None
+                elif child >= i:
+                    return None
+        return nodes, ssector_sectors
+
     def compare_vertex_positions(self,vertex1,vertex2):
         """Compares the positions of two vertices."""
         if (vertex1.x == vertex2.x):
@@ -384,28 +586,62 @@ class MapEditor:
             return True
         return False
     
+    def _sector_indexes(self, sectors, ids):
+        """Return the set of indexes of sectors given as indexes or
+        Sector objects (which may be in the list more than once). ids
+        is a dict of the indexes of each Sector object by id, which is
+        filled in the first time an object is looked up."""
+        indexes = set()
+        for sector in sectors:
+            if isinstance(sector, int):
+                indexes.add(sector)
+                continue
+            if not ids:
+                for i, s in enumerate(self.sectors):
+                    ids.setdefault(id(s), []).append(i)
+            indexes.update(ids.get(id(sector), ()))
+        return indexes
+
     def combine_sectors(self,sector1,sector2,remove_linedefs=True):
         """Combines two sectors together, replacing all references to
         the second with the first. If remove_linedefs is true, any 
-        linedefs that connect the two sectors will be removed."""
+        linedefs that connect the two sectors will be removed.
+        
+        Sectors may be given as indexes or Sector objects. sector2 may
+        also be a list of sectors, which are all combined into the
+        first at once."""
+        if not isinstance(sector2, (list, tuple, set)):
+            sector2 = [sector2]
+        ids = {}
+        merged = self._sector_indexes(sector2, ids)
+        targets = self._sector_indexes([sector1], ids)
+        if not targets:
+            raise ValueError("sector1 is not in this map")
+        target = min(targets)
+        
+        # reassign the sidedefs, and note the sector of every sidedef
+        changed = False
+        side_sectors = []
         for sd in self.sidedefs:
-            if (self.sectors[sd.sector] == sector2):
-                sd.sector = self.sectors.index(sector1)
-                
-                if (remove_linedefs):
-                    for lc in self.linedefs:
-                        if (lc.back != -1):
-                            if (self.sectors[self.sidedefs[lc.front].sector] == sector1 and 
-                                self.sectors[self.sidedefs[lc.back].sector] == sector1):
-                                self.linedefs.remove(lc)
+            if sd.sector in merged:
+                sd.sector = target
+                changed = True
+            side_sectors.append(sd.sector)
+        
+        # remove linedefs with the combined sector on both sides
+        if remove_linedefs and changed:
+            self.linedefs[:] = [lc for lc in self.linedefs
+                if lc.back == -1 or
+                   side_sectors[lc.front] not in targets or
+                   side_sectors[lc.back] not in targets]
         # we can rely on a nodebuilder to remove unused sectors
         # self.sectors[self.sectors.index(sector2)].tx_floor = "_REMOVED"
         
-        
-        
     def paste(self, other, offset=(0,0)):
         """Insert content of another map."""
+        indexed = self.__dict__.get("_edges_state") == self._list_state()
         vlen = len(self.vertexes)
+        llen = len(self.linedefs)
         ilen = len(self.sidedefs)
         slen = len(self.sectors)
         for vx in other.vertexes:
@@ -430,4 +666,239 @@ class MapEditor:
             z.x += offset[0]
             z.y += offset[1]
             self.things.append(z)
+        if indexed:
+            self._index_linedefs(llen)
+
+
+class _Columns(object):
+    """The records of a map lump as columns of the array module,
+    used by ArrayMap when NumPy is not available. Name fields are
+    lists of byte strings. Supports the parts of the NumPy
+    structured array interface that ArrayMap uses; columns are plain
+    arrays, so comparing a column with a value gives a single bool
+    rather than one per row."""
+
+    def __init__(self, class_, columns):
+        self.class_  = class_
+        self.columns = columns
+
+    @classmethod
+    def from_bytes(cls, class_, data):
+        rows = list(zip(*iter_unpack(class_._struct, data))) or \
+            [()] * len(class_._fields)
+        columns = OrderedDict()
+        for name, fmt, values in zip(class_._fields, class_._field_formats, rows):
+            if 's' in fmt:
+                # like NumPy, strip the zero-padding
+                columns[name] = [v.rstrip(b"\0") for v in values]
+            else:
+                columns[name] = array(fmt, values)
+        return cls(class_, columns)
+
+    def __len__(self):
+        return len(self.columns[self.class_._fields[0]])
+
+    def __getitem__(self, key):
+        """Get a column by name, or the rows where key is true."""
+        if isinstance(key, str):
+            return self.columns[key]
+        columns = OrderedDict()
+        for name, values in self.columns.items():
+            kept = [v for v, k in zip(values, key) if k]
+            columns[name] = kept if isinstance(values, list) \
+                else array(values.typecode, kept)
+        return _Columns(self.class_, columns)
+
+    def __setitem__(self, name, values):
+        column = self.columns[name]
+        if isinstance(column, list):
+            self.columns[name] = list(values)
+        else:
+            self.columns[name] = array(column.typecode, values)
+
+    def copy(self):
+        return self[[True] * len(self)]
+
+    def tobytes(self):
+        pack = self.class_._struct.pack
+        return join([pack(*row) for row in zip(*self.columns.values())])
+
+
+class ArrayMap:
+    """Columnar Doom map editor
+
+    Keeps each map lump as one table of records, a NumPy structured
+    array if NumPy is installed, or else columns of the array module.
+    Columns are accessed by field name, eg. map.vertexes["x"], and tables
+    are filtered with a sequence of booleans, eg.
+    map.things[[t != 3004 for t in map.things["type"]]]. With NumPy,
+    comparisons of whole columns also work, eg.
+    map.things[map.things["type"] != 3004]. Unlike MapEditor, unused
+    linedef sides are 0xFFFF, as stored in the lump.
+
+    Tables are loaded from the lump data without copying, and are
+    copied the first time they are modified in place. Saving packs each
+    table with a single tobytes().
+
+    Data members:
+        header, vertexes, sidedefs, linedefs, sectors, things,
+        segs, ssectors, nodes, blockmap, reject
+        (behavior, scripts in Hexen/ZDoom format)
+        Thing, Linedef  record classes, depending on format
+    """
+
+    def __init__(self, from_lumps=None):
+        """Create new, optionally from a lump group"""
+        if from_lumps is None:
+            from_lumps = MapEditor().to_lumps()
+        self.from_lumps(from_lumps)
+
+    @staticmethod
+    def _table(class_, data):
+        """Return the records of lump data in a table."""
+        if np is None:
+            return _Columns.from_bytes(class_, data)
+        dtype = np.dtype([(name, ("S" + fmt[:-1]) if 's' in fmt else "<" + fmt)
+                          for name, fmt in zip(class_._fields, class_._field_formats)])
+        return np.frombuffer(data, dtype)
+
+    @staticmethod
+    def _writable(table):
+        """Return table, or a copy if it is a read-only view."""
+        if np is not None and not table.flags.writeable:
+            return table.copy()
+        return table
+
+    def from_lumps(self, lumpgroup):
+        """Load tables from a lump group."""
+        m = lumpgroup
+        try:
+            self.header = m["_HEADER_"]
+            if "BEHAVIOR" in m:
+                # Hexen / ZDoom map
+                self.Thing    = ZThing
+                self.Linedef  = ZLinedef
+                self.behavior = m["BEHAVIOR"]
+                try:
+                    self.scripts = m[wcinlist(m, "SCRIPT*")[0]]
+                except IndexError:
+                    self.scripts = Lump()
+            else:
+                self.Thing   = Thing
+                self.Linedef = Linedef
+                try:
+                    del self.behavior
+                    del self.scripts
+                except AttributeError:
+                    pass
+            self.vertexes = self._table(Vertex,       m["VERTEXES"].data)
+            self.sidedefs = self._table(Sidedef,      m["SIDEDEFS"].data)
+            self.sectors  = self._table(Sector,       m["SECTORS"].data)
+            self.things   = self._table(self.Thing,   m["THINGS"].data)
+            self.linedefs = self._table(self.Linedef, m["LINEDEFS"].data)
+        except KeyError as e:
+            raise ValueError("map is missing %s lump" % e)
+
+        from struct import error as StructError
+        try:
+            self.ssectors = self._table(SubSector, m["SSECTORS"].data)
+            self.segs     = self._table(Seg,       m["SEGS"].data)
+            self.nodes    = self._table(Node,      m["NODES"].data)
+            self.blockmap = m["BLOCKMAP"]
+            self.reject   = m["REJECT"]
+        except (KeyError, ValueError, StructError):
+            # nodes are missing or in another format, they get rebuilt
+            self.clear_nodes()
+
+    def to_lumps(self):
+        m = NameGroup()
+        m["_HEADER_"] = self.header
+        m["VERTEXES"] = Lump(self.vertexes.tobytes())
+        m["THINGS"  ] = Lump(self.things.tobytes())
+        m["LINEDEFS"] = Lump(self.linedefs.tobytes())
+        m["SIDEDEFS"] = Lump(self.sidedefs.tobytes())
+        m["SECTORS" ] = Lump(self.sectors.tobytes())
+        m["NODES"]    = Lump(self.nodes.tobytes())
+        m["SEGS"]     = Lump(self.segs.tobytes())
+        m["SSECTORS"] = Lump(self.ssectors.tobytes())
+        m["BLOCKMAP"] = self.blockmap
+        m["REJECT"]   = self.reject
+
+        # hexen / zdoom script lumps
+        try:
+            m["BEHAVIOR"] = self.behavior
+            m["SCRIPTS"]  = self.scripts
+        except AttributeError:
+            pass
+
+        return m
+
+    @classmethod
+    def from_editor(cls, editor):
+        """Create from a MapEditor."""
+        return cls(editor.to_lumps())
+
+    def to_editor(self):
+        """Return a new MapEditor with the content of this map."""
+        return MapEditor(self.to_lumps())
+
+    def clear_nodes(self):
+        """Remove the nodes, segs and subsectors, and the blockmap
+        and reject tables, which have to be rebuilt by a node builder."""
+        self.ssectors = self._table(SubSector, b"")
+        self.segs     = self._table(Seg,       b"")
+        self.nodes    = self._table(Node,      b"")
+        self.blockmap = Lump(b"")
+        self.reject   = Lump(b"")
+
+    def _add(self, table, field, value):
+        if np is not None:
+            table[field] += value
+        else:
+            table[field] = [v + value for v in table[field]]
+
+    def translate(self, dx, dy):
+        """Move all vertexes, things and nodes by (dx, dy)."""
+        self.vertexes = self._writable(self.vertexes)
+        self.things   = self._writable(self.things)
+        self.nodes    = self._writable(self.nodes)
+        for table in (self.vertexes, self.things):
+            self._add(table, "x", dx)
+            self._add(table, "y", dy)
+        self._add(self.nodes, "x_start", dx)
+        self._add(self.nodes, "y_start", dy)
+        for side in ("right", "left"):
+            self._add(self.nodes, side + "_bbox_top",    dy)
+            self._add(self.nodes, side + "_bbox_bottom", dy)
+            self._add(self.nodes, side + "_bbox_left",   dx)
+            self._add(self.nodes, side + "_bbox_right",  dx)
+
+    def mirror(self):
+        """Mirror the map horizontally. Linedefs are flipped to keep
+        their front sides, and the nodes are cleared."""
+        self.vertexes = self._writable(self.vertexes)
+        self.things   = self._writable(self.things)
+        self.linedefs = self._writable(self.linedefs)
+        if np is not None:
+            self.vertexes["x"] *= -1
+            self.things["x"]   *= -1
+            self.things["angle"] = (180 - self.things["angle"].astype(np.int32)) % 360
+            vx_a = self.linedefs["vx_a"].copy()
+            self.linedefs["vx_a"] = self.linedefs["vx_b"]
+            self.linedefs["vx_b"] = vx_a
+        else:
+            self.vertexes["x"] = [-x for x in self.vertexes["x"]]
+            self.things["x"]   = [-x for x in self.things["x"]]
+            self.things["angle"] = [(180 - a) % 360 for a in self.things["angle"]]
+            vx_a = self.linedefs["vx_a"]
+            self.linedefs["vx_a"] = self.linedefs["vx_b"]
+            self.linedefs["vx_b"] = vx_a
+        self.clear_nodes()
 
+    def filter_things(self, keep):
+        """Keep only the things where keep is true. keep is a sequence
+        of booleans, or a function returning one for the things table,
+        eg. lambda things: [t != 3004 for t in things["type"]]"""
+        if callable(keep):
+            keep = keep(self.things)
+        self.things = self.things[keep]
@@ -1,7 +1,17 @@
+import hashlib
+import os
+import sys
+from array    import array
 from omg      import six
 from struct   import pack, unpack
 from omg.util import *
 
+# RGB lookup tables are built with NumPy if it is available
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 class Palette:
 
     """Used for storing a list of colors and doing things with them
@@ -27,6 +37,8 @@ class Palette:
         .grays        List of indices of colors with zero saturation
         .bright_lut   Brightness LUT, used internally to speed up
                       lookups (when not memoized).
+        .rgb_table    RGBTable used for lookups instead of the above,
+                      if built with build_rgb_table
     """
 
     def __init__(self, colors=None, tran_index=None, tran_color=None):
@@ -65,6 +77,7 @@ class Palette:
         # below for description of what bright_lut does.
         self.memo = {}
         self.bright_lut = []
+        self.rgb_table = None
         self.reset_memo()
 
     def make_bytes(self):
@@ -124,11 +137,40 @@ class Palette:
                 candidates.append(best_i)
             self.bright_lut.append(candidates)
 
+    def build_rgb_table(self, cache_dir=None):
+        """Build an RGBTable for looking up the exact closest match of
+        any color, which match uses from then on instead of the memo
+        and brightness LUT. Palettes with the same colors share their
+        table. If 'cache_dir' is given, the table is saved there and
+        loaded again by later sessions.
+
+        With NumPy the table takes a few seconds to build. Without it,
+        parts of the table are filled in as colors are looked up."""
+        key = hashlib.sha1(self.bytes).hexdigest()
+        table = _rgb_tables.get(key)
+        if table is None and cache_dir is not None:
+            path = os.path.join(cache_dir, "palette-%s.rgb" % key)
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            if os.path.isfile(path):
+                table = RGBTable.load(self.colors, path)
+            else:
+                table = RGBTable(self.colors)
+                if table.complete():
+                    table.save(path)
+        if table is None:
+            table = RGBTable(self.colors)
+        _rgb_tables[key] = table
+        self.rgb_table = table
+        return table
+
     def match(self, color):
         """Find the closest match in the palette for a color.
         Takes an (r,g,b) tuple as argument and returns a palette index."""
         if color == self.tran_color:
             return self.tran_index
+        if self.rgb_table is not None:
+            return self.rgb_table.lookup(*color)
         if color in self.memo:
             return self.memo[color]
         if len(self.bright_lut) == 0:
@@ -151,6 +193,95 @@ class Palette:
         self.memo[color] = best_i
         return best_i
 
+    def match_many(self, buffer, mode='RGB'):
+        """Find the closest matches in the palette for a buffer of
+        pixels, as bytes in 'RGB' or 'RGBA' mode. Returns a pair of
+        bytes objects: the palette index of each pixel, and a mask
+        which is 1 for opaque and 0 for transparent (zero alpha)
+        pixels. Transparent pixels get the transparency index.
+
+        The results are the same as calling match for every pixel,
+        but each distinct color is only looked up once, and with
+        NumPy all pixels are looked up together."""
+        if mode not in ('RGB', 'RGBA'):
+            raise TypeError("mode must be 'RGB' or 'RGBA'")
+        channels = len(mode)
+        count = len(buffer) // channels
+        if np is None:
+            indices = bytearray(count)
+            found = {}
+            for i in range(count):
+                color = tuple(six.iterbytes(buffer[i*channels:i*channels+3]))
+                index = found.get(color)
+                if index is None:
+                    index = found[color] = self.match(color)
+                indices[i] = index
+            if channels == 4:
+                mask = bytearray(1 if alpha else 0 for alpha
+                                 in six.iterbytes(buffer[3:count*4:4]))
+                for i in range(count):
+                    if not mask[i]:
+                        indices[i] = self.tran_index
+            else:
+                mask = bytearray([1]) * count
+            return bytes(indices), bytes(mask)
+
+        pixels = np.frombuffer(buffer, dtype=np.uint8, count=count*channels)
+        pixels = pixels.reshape(count, channels).astype(np.int32)
+        red, green, blue = pixels[:, 0], pixels[:, 1], pixels[:, 2]
+        keys = red << 16 | green << 8 | blue
+        if self.rgb_table is not None:
+            indices = self.rgb_table.lookup_many(red, green, blue)
+        else:
+            unique, inverse = np.unique(keys, return_inverse=True)
+            indices = self._match_keys(unique)[inverse.ravel()]
+        tr, tg, tb = self.tran_color
+        indices[keys == (tr << 16 | tg << 8 | tb)] = self.tran_index
+        if channels == 4:
+            mask = pixels[:, 3] > 0
+            indices[~mask] = self.tran_index
+        else:
+            mask = np.ones(count, dtype=bool)
+        return (indices.astype(np.uint8).tobytes(),
+                mask.astype(np.uint8).tobytes())
+
+    def _match_keys(self, keys):
+        """Find the closest matches of an array of distinct 24-bit RGB
+        keys with NumPy, searching the brightness LUT like match."""
+        indices = np.empty(len(keys), dtype=np.int32)
+        missing = []
+        for i, key in enumerate(keys.tolist()):
+            index = self.memo.get((key >> 16, key >> 8 & 255, key & 255))
+            if index is None:
+                missing.append(i)
+            else:
+                indices[i] = index
+        if not missing:
+            return indices
+        if len(self.bright_lut) == 0:
+            self.build_lut()
+        # candidate lists padded to the same length, the padding never
+        # gets picked
+        width = max(len(candidates) for candidates in self.bright_lut)
+        lut = np.array([candidates + [candidates[0]] * (width - len(candidates))
+                        for candidates in self.bright_lut], dtype=np.int32)
+        padding = np.array([[j >= len(candidates) for j in range(width)]
+                            for candidates in self.bright_lut])
+        missing = np.array(missing)
+        keys = keys[missing]
+        rgb = np.column_stack([keys >> 16, keys >> 8 & 255, keys & 255])
+        levels = rgb.sum(1) // 3
+        candidates = lut[levels]
+        colors = np.array(self.colors, dtype=np.int32)[candidates]
+        dist = sum((colors[:, :, k] - rgb[:, None, k]) ** 2 for k in range(3))
+        dist[padding[levels]] = 1 << 30
+        # the first closest candidate, as in match
+        best = candidates[np.arange(len(keys)), dist.argmin(1)]
+        indices[missing] = best
+        for color, index in zip(rgb.tolist(), best.tolist()):
+            self.memo[tuple(color)] = index
+        return indices
+
     def blend(self, color, intensity=0.5):
         """Blend the entire palette against a color (given as an RGB triple).
         Intensity must be a floating-point number in the range 0-1."""
@@ -168,6 +299,181 @@ class Palette:
         self.make_grays()
         self.reset_memo()
         self.bright_lut = []
+        self.rgb_table = None
+
+# RGB tables already built, by hash of the palette colors
+_rgb_tables = {}
+
+class RGBTable:
+
+    """Lookup table from RGB colors to the index of the closest color
+    in a palette, by squared distance. Ties go to the lowest index.
+
+    RGB space is divided into 64x64x64 cells of 4x4x4 colors. Most
+    cells have a single closest palette color for all of their colors;
+    the rest refer to a block of 64 indices, one for each color.
+
+        .colors   List of (r, g, b) tuples of the palette
+        .cells    Palette index of each cell, or 256 + the number of
+                  its block (-1 for cells not filled in yet)
+        .blocks   Blocks of 64 palette indices, in r, g, b order
+    """
+
+    def __init__(self, colors, cells=None, blocks=None):
+        """Create a table for a list of (r, g, b) tuples, built with
+        NumPy if available. Otherwise cells are filled in when used."""
+        self.colors = list(colors)
+        if cells is None:
+            if np is not None:
+                cells, blocks = _build_rgb_cells(self.colors)
+            else:
+                cells, blocks = array('i', [-1]) * 262144, bytearray()
+        self.cells = cells
+        self.blocks = blocks
+
+    def __deepcopy__(self, memo):
+        # tables depend on the colors only, palette copies share them
+        return self
+
+    def complete(self):
+        """Test whether all cells are filled in."""
+        return min(self.cells) >= 0
+
+    def lookup(self, r, g, b):
+        """Return the palette index of the closest color to r, g, b."""
+        cell = (r >> 2) << 12 | (g >> 2) << 6 | b >> 2
+        value = int(self.cells[cell])
+        if value < 0:
+            value = self._fill(cell)
+        if value < 256:
+            return value
+        return int(self.blocks[(value - 256) * 64 +
+                               ((r & 3) << 4 | (g & 3) << 2 | b & 3)])
+
+    def lookup_many(self, red, green, blue):
+        """Return the palette indices of the closest colors to NumPy
+        arrays of red, green and blue values, as an array."""
+        cells = red >> 2 << 12 | green >> 2 << 6 | blue >> 2
+        indices = np.asarray(self.cells)[cells].astype(np.int32)
+        mixed = indices >= 256
+        if mixed.any():
+            offsets = ((red & 3) << 4 | (green & 3) << 2 | blue & 3)[mixed]
+            indices[mixed] = np.asarray(self.blocks)[
+                (indices[mixed] - 256) * 64 + offsets]
+        return indices
+
+    def _fill(self, cell):
+        """Find the closest palette colors of a cell."""
+        r0, g0, b0 = (cell >> 12) * 4, (cell >> 6 & 63) * 4, (cell & 63) * 4
+        block = bytearray(64)
+        for i in range(64):
+            ar, ag, ab = r0 + (i >> 4), g0 + (i >> 2 & 3), b0 + (i & 3)
+            best_dist = 262144
+            for j, (br, bg, bb) in enumerate(self.colors):
+                dist = (ar-br)*(ar-br) + (ag-bg)*(ag-bg) + (ab-bb)*(ab-bb)
+                if dist < best_dist:
+                    best_dist = dist
+                    block[i] = j
+        if block == block[:1] * 64:
+            value = block[0]
+        else:
+            value = 256 + len(self.blocks) // 64
+            self.blocks += block
+        self.cells[cell] = value
+        return value
+
+    def save(self, path):
+        """Write a complete table to a file."""
+        if np is not None:
+            cells = np.asarray(self.cells, dtype='<i4').tobytes()
+        else:
+            cells = array('i', self.cells)
+            if sys.byteorder == 'big':
+                cells.byteswap()
+            cells = cells.tostring() if six.PY2 else cells.tobytes()
+        # write to a temporary file first, other processes may be
+        # loading the table at the same time
+        temp = "%s.%d.tmp" % (path, os.getpid())
+        with open(temp, 'wb') as f:
+            f.write(cells)
+            f.write(bytes(self.blocks))
+        if six.PY2:
+            # no atomic replace, but renaming over a file works on POSIX
+            os.rename(temp, path)
+        else:
+            os.replace(temp, path)
+
+    @classmethod
+    def load(cls, colors, path):
+        """Read a table of a list of (r, g, b) tuples from a file."""
+        with open(path, 'rb') as f:
+            data = f.read()
+        if np is not None:
+            cells = np.frombuffer(data, dtype='<i4', count=262144)
+            blocks = np.frombuffer(data, dtype=np.uint8, offset=262144*4)
+        else:
+            cells = array('i')
+            if six.PY2:
+                cells.fromstring(data[:262144*4])
+            else:
+                cells.frombytes(data[:262144*4])
+            if sys.byteorder == 'big':
+                cells.byteswap()
+            blocks = bytearray(data[262144*4:])
+        return cls(colors, cells, blocks)
+
+def _build_rgb_cells(colors):
+    """Build the cells and blocks of an RGBTable with NumPy."""
+    # only the first of equal colors can be the closest
+    firsts = [i for i, rgb in enumerate(colors) if colors.index(rgb) == i]
+    indexes = np.array(firsts, dtype=np.int32)
+    palette = np.array([colors[i] for i in firsts], dtype=np.float64)
+    norms = (palette * palette).sum(1)
+    spans = np.abs(palette[:, None, :] - palette[None, :, :]).sum(2)
+    centers = np.arange(64) * 4 + 1.5
+    green_blue = np.stack(np.meshgrid(centers, centers, indexing='ij'),
+                          -1).reshape(-1, 2)
+    offsets = np.stack(np.meshgrid(*[np.arange(4)] * 3, indexing='ij'),
+                       -1).reshape(-1, 3)
+    rows = np.arange(4096)
+    cells = np.empty(262144, dtype=np.int32)
+    blocks = []
+    block_count = 0
+    for red in range(64):
+        points = np.column_stack([np.full(4096, centers[red]), green_blue])
+        products = points.dot(palette.T)
+        nearest = (norms - 2 * products).argmin(1)
+        # a color can be closer than the one nearest to the center
+        # somewhere in the cell if the cell crosses their bisecting
+        # plane, ie. the corner of the cell closest to the color is
+        # on its side
+        slack = (products - products[rows, nearest][:, None] +
+                 1.5 * spans[nearest] - (norms - norms[nearest][:, None]) / 2)
+        candidates = slack >= 0
+        row_cells = indexes[nearest]
+        mixed = np.nonzero(candidates.sum(1) > 1)[0]
+        if len(mixed):
+            # closest of the candidates for each color of the cell
+            candidates = candidates[mixed]
+            width = candidates.sum(1).max()
+            order = np.argsort(~candidates, axis=1, kind='stable')[:, :width]
+            valid = np.take_along_axis(candidates, order, 1)
+            near = palette[order].astype(np.int32)
+            corners = (points[mixed] - 1.5).astype(np.int32)
+            cell_colors = corners[:, None, :] + offsets
+            dist = sum((cell_colors[:, :, None, k] - near[:, None, :, k]) ** 2
+                       for k in range(3))
+            dist[~np.broadcast_to(valid[:, None, :], dist.shape)] = 1 << 30
+            best = np.take_along_axis(order, dist.argmin(2), 1)
+            blocks.append(indexes[best].astype(np.uint8).ravel())
+            row_cells[mixed] = 256 + block_count + np.arange(len(mixed))
+            block_count += len(mixed)
+        cells[red*4096:(red+1)*4096] = row_cells
+    if blocks:
+        blocks = np.concatenate(blocks)
+    else:
+        blocks = np.zeros(0, dtype=np.uint8)
+    return cells, blocks
 
 # Colors of the Doom palette, used by default
 default_colors = (
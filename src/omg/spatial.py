@@ -0,0 +1,320 @@
+"""
+    Spatial index of map geometry, for finding the things and linedefs
+    near a point, in a box or along a ray without scanning the map.
+"""
+
+from math import floor, sqrt
+
+# Size of blockmap blocks in map units
+BLOCK_SIZE = 128
+
+class SpatialIndex:
+    """A uniform grid over map space, with blocks of 128 units like
+    Doom's BLOCKMAP, holding the indexes of linedefs and things.
+
+    Linedefs are added to every block they pass through and things to
+    the block they are in. Queries collect candidates from the blocks
+    they touch and then test the exact geometry, so they only look at
+    the parts of the map near the query.
+
+    Data members:
+        x_origin, y_origin  Corner of block (0, 0), the lowest vertex
+                            coordinates as in BLOCKMAP
+        block_size          Size of the blocks
+        vertexes            List of (x, y) vertex positions
+        linedefs            List of (vertex a, vertex b) index pairs
+        things              List of (x, y) thing positions
+        sides               List of (front sector, back sector) of
+                            linedefs, or None (-1 for no sector)
+    """
+
+    def __init__(self, vertexes=(), linedefs=(), things=(), sides=None,
+                 block_size=BLOCK_SIZE):
+        """Build an index from lists of (x, y) vertex positions,
+        (vertex a, vertex b) linedef index pairs and (x, y) thing
+        positions. sides optionally gives the sectors on each side of
+        the linedefs."""
+        self.vertexes = [(x, y) for x, y in vertexes]
+        self.linedefs = [(a, b) for a, b in linedefs]
+        self.things   = [(x, y) for x, y in things]
+        self.sides    = sides
+        self.block_size = block_size
+        if self.vertexes:
+            self.x_origin = min(x for x, y in self.vertexes)
+            self.y_origin = min(y for x, y in self.vertexes)
+        else:
+            self.x_origin = self.y_origin = 0
+        self.line_blocks  = {}
+        self.thing_blocks = {}
+        for i, (a, b) in enumerate(self.linedefs):
+            x1, y1 = self.vertexes[a]
+            x2, y2 = self.vertexes[b]
+            for block in self._segment_blocks(x1, y1, x2, y2):
+                self.line_blocks.setdefault(block, []).append(i)
+        for i, (x, y) in enumerate(self.things):
+            self.thing_blocks.setdefault(self._block(x, y), []).append(i)
+
+    @classmethod
+    def from_map(cls, map, block_size=BLOCK_SIZE):
+        """Build an index of a MapEditor or ArrayMap."""
+        from omg.mapedit import ArrayMap
+        if isinstance(map, ArrayMap):
+            # columns as Python ints, NumPy's 16 bit integers overflow
+            def column(records, name):
+                return records[name].tolist()
+            vertexes = zip(column(map.vertexes, "x"), column(map.vertexes, "y"))
+            linedefs = zip(column(map.linedefs, "vx_a"),
+                           column(map.linedefs, "vx_b"))
+            things   = zip(column(map.things, "x"), column(map.things, "y"))
+            sectors  = column(map.sidedefs, "sector")
+            fronts = column(map.linedefs, "front")
+            backs  = column(map.linedefs, "back")
+            nothing = 0xFFFF
+        else:
+            vertexes = [(v.x, v.y) for v in map.vertexes]
+            linedefs = [(l.vx_a, l.vx_b) for l in map.linedefs]
+            things   = [(t.x, t.y) for t in map.things]
+            sectors  = [sd.sector for sd in map.sidedefs]
+            fronts = [l.front for l in map.linedefs]
+            backs  = [l.back  for l in map.linedefs]
+            nothing = -1
+        sides = [(sectors[f] if f != nothing else -1,
+                  sectors[b] if b != nothing else -1)
+                 for f, b in zip(fronts, backs)]
+        return cls(vertexes, linedefs, things, sides, block_size)
+
+    def _block(self, x, y):
+        """Return the (column, row) of the block containing a point."""
+        return (int(floor((x - self.x_origin) / float(self.block_size))),
+                int(floor((y - self.y_origin) / float(self.block_size))))
+
+    def _segment_blocks(self, x1, y1, x2, y2):
+        """Yield the blocks a line segment passes through."""
+        if x1 > x2:
+            x1, y1, x2, y2 = x2, y2, x1, y1
+        size = self.block_size
+        col1 = self._block(x1, y1)[0]
+        col2 = self._block(x2, y2)[0]
+        for col in range(col1, col2 + 1):
+            # the part of the segment within this column
+            xa = max(x1, self.x_origin + col * size)
+            xb = min(x2, self.x_origin + (col + 1) * size)
+            if x1 == x2:
+                ya, yb = y1, y2
+            else:
+                slope = (y2 - y1) / float(x2 - x1)
+                ya = y1 + (xa - x1) * slope
+                yb = y1 + (xb - x1) * slope
+            row1 = self._block(xa, ya)[1]
+            row2 = self._block(xb, yb)[1]
+            if row1 > row2:
+                row1, row2 = row2, row1
+            for row in range(row1, row2 + 1):
+                yield (col, row)
+
+    def _box_blocks(self, x1, y1, x2, y2):
+        """Yield the blocks overlapping a box."""
+        col1, row1 = self._block(min(x1, x2), min(y1, y2))
+        col2, row2 = self._block(max(x1, x2), max(y1, y2))
+        for col in range(col1, col2 + 1):
+            for row in range(row1, row2 + 1):
+                yield (col, row)
+
+    def _candidates(self, blocks, index):
+        found = set()
+        for block in blocks:
+            found.update(index.get(block, ()))
+        return found
+
+    def _ends(self, i):
+        a, b = self.linedefs[i]
+        return self.vertexes[a] + self.vertexes[b]
+
+    def things_in_box(self, x1, y1, x2, y2):
+        """Return the sorted indexes of things inside a box."""
+        left, right = min(x1, x2), max(x1, x2)
+        bottom, top = min(y1, y2), max(y1, y2)
+        found = self._candidates(self._box_blocks(x1, y1, x2, y2),
+                                 self.thing_blocks)
+        return sorted(i for i in found
+                      if left <= self.things[i][0] <= right and
+                         bottom <= self.things[i][1] <= top)
+
+    def things_in_radius(self, x, y, radius):
+        """Return the sorted indexes of things within a distance of a
+        point."""
+        r2 = radius * radius
+        return [i for i in self.things_in_box(x - radius, y - radius,
+                                              x + radius, y + radius)
+                if (self.things[i][0] - x) ** 2 +
+                   (self.things[i][1] - y) ** 2 <= r2]
+
+    def linedefs_in_box(self, x1, y1, x2, y2):
+        """Return the sorted indexes of linedefs crossing or inside
+        a box."""
+        left, right = min(x1, x2), max(x1, x2)
+        bottom, top = min(y1, y2), max(y1, y2)
+        found = self._candidates(self._box_blocks(x1, y1, x2, y2),
+                                 self.line_blocks)
+        return sorted(i for i in found
+                      if _clip_segment(self._ends(i), left, bottom,
+                                       right, top))
+
+    def linedefs_in_radius(self, x, y, radius):
+        """Return the sorted indexes of linedefs passing within a
+        distance of a point."""
+        return [i for i in self.linedefs_in_box(x - radius, y - radius,
+                                                x + radius, y + radius)
+                if _point_segment_distance(x, y, self._ends(i)) <= radius]
+
+    def linedefs_on_ray(self, x1, y1, x2, y2):
+        """Return the indexes of linedefs crossed by the segment from
+        (x1, y1) to (x2, y2), ordered by distance from (x1, y1)."""
+        found = self._candidates(self._segment_blocks(x1, y1, x2, y2),
+                                 self.line_blocks)
+        hits = []
+        for i in found:
+            t = _segment_intersection((x1, y1, x2, y2), self._ends(i))
+            if t is not None:
+                hits.append((t, i))
+        return [i for t, i in sorted(hits)]
+
+    def sectors_in_radius(self, x, y, radius):
+        """Return the sorted indexes of sectors on either side of the
+        linedefs within a distance of a point. Needs sides."""
+        if self.sides is None:
+            raise ValueError("the index has no sector information")
+        sectors = set()
+        for i in self.linedefs_in_radius(x, y, radius):
+            sectors.update(self.sides[i])
+        sectors.discard(-1)
+        return sorted(sectors)
+
+    def locate_sectors(self, points):
+        """Return the index of the sector containing each (x, y) point,
+        or -1 for points outside the map. Needs sides.
+
+        A ray is cast from each point towards +x, and the nearest
+        linedef it crosses tells the sector on the side of the point.
+        Rays through vertexes are taken as passing just below them.
+
+        Points on a linedef are placed like Doom's BSP walk places
+        them on a partition line along the linedef: below horizontal
+        lines, left of vertical lines and otherwise on the back. Points
+        on one-sided linedefs are in the sector of the linedef."""
+        if self.sides is None:
+            raise ValueError("the index has no sector information")
+        if not self.vertexes:
+            return [-1 for point in points]
+        x_max = max(x for x, y in self.vertexes)
+        size = self.block_size
+        found = []
+        for x, y in points:
+            col, row = self._block(x, y)
+            last_col = self._block(x_max, y)[0]
+            nearest, sector = None, -1
+            seen = set()
+            # search the blocks along the ray until one holds a crossing
+            while col <= last_col:
+                # neighbouring rows too, for lines ending on block edges
+                for block in ((col, row - 1), (col, row), (col, row + 1)):
+                    for i in self.line_blocks.get(block, ()):
+                        if i in seen:
+                            continue
+                        seen.add(i)
+                        x1, y1, x2, y2 = self._ends(i)
+                        sides = self.sides[i]
+                        if y1 == y2:
+                            # the ray passes below horizontal lines,
+                            # but a point on a wall is in its sector
+                            if y == y1 and min(x1, x2) <= x <= max(x1, x2) \
+                               and -1 in sides:
+                                nearest = (x, float("-inf"))
+                                sector = max(sides)
+                            continue
+                        if not min(y1, y2) < y <= max(y1, y2):
+                            continue
+                        inverse = (x2 - x1) / float(y2 - y1)
+                        # sort lines meeting at the crossing by where
+                        # they are just below it
+                        crossing = (x1 + (y - y1) * inverse, -inverse)
+                        if crossing[0] < x or (nearest is not None and
+                                               crossing >= nearest):
+                            continue
+                        # the front of a linedef is on its right
+                        cross = (x2 - x1) * (y - y1) - (y2 - y1) * (x - x1)
+                        side = 0 if cross < 0 else 1
+                        if cross == 0:
+                            # on the line, as on a partition line along
+                            # it: left of vertical lines, otherwise on
+                            # the back, but in the sector of a wall
+                            side = 0 if x1 == x2 and y2 < y1 else 1
+                            if sides[side] == -1:
+                                side = 1 - side
+                        nearest = crossing
+                        sector = sides[side]
+                col += 1
+                if (nearest is not None and
+                    nearest[0] < self.x_origin + col * size):
+                    break
+            found.append(sector)
+        return found
+
+
+def _clip_segment(segment, left, bottom, right, top):
+    """Test whether a line segment crosses a box (Liang-Barsky)."""
+    x1, y1, x2, y2 = segment
+    dx, dy = x2 - x1, y2 - y1
+    t0, t1 = 0.0, 1.0
+    for p, q in ((-dx, x1 - left), (dx, right - x1),
+                 (-dy, y1 - bottom), (dy, top - y1)):
+        if p == 0:
+            if q < 0:
+                return False
+        else:
+            t = q / float(p)
+            if p < 0:
+                t0 = max(t0, t)
+            else:
+                t1 = min(t1, t)
+            if t0 > t1:
+                return False
+    return True
+
+def _point_segment_distance(x, y, segment):
+    """Return the distance from a point to a line segment."""
+    x1, y1, x2, y2 = segment
+    dx, dy = x2 - x1, y2 - y1
+    length2 = dx * dx + dy * dy
+    if length2 == 0:
+        t = 0.0
+    else:
+        t = max(0.0, min(1.0, ((x - x1) * dx + (y - y1) * dy) / float(length2)))
+    px, py = x1 + t * dx, y1 + t * dy
+    return sqrt((x - px) ** 2 + (y - py) ** 2)
+
+def _segment_intersection(ray, segment):
+    """Return the position (0 to 1) along ray where it crosses a line
+    segment, or None. Touching counts as crossing."""
+    x1, y1, x2, y2 = ray
+    x3, y3, x4, y4 = segment
+    rdx, rdy = x2 - x1, y2 - y1
+    sdx, sdy = x4 - x3, y4 - y3
+    denom = rdx * sdy - rdy * sdx
+    if denom == 0:
+        # parallel, or collinear and overlapping
+        if (x3 - x1) * rdy - (y3 - y1) * rdx != 0:
+            return None
+        length2 = float(rdx * rdx + rdy * rdy)
+        if length2 == 0:
+            return None
+        ts = [((x - x1) * rdx + (y - y1) * rdy) / length2
+              for x, y in ((x3, y3), (x4, y4))]
+        if max(ts) < 0 or min(ts) > 1:
+            return None
+        return max(0.0, min(ts))
+    t = ((x3 - x1) * sdy - (y3 - y1) * sdx) / float(denom)
+    u = ((x3 - x1) * rdy - (y3 - y1) * rdx) / float(denom)
+    if 0 <= t <= 1 and 0 <= u <= 1:
+        return t
+    return None
@@ -3,6 +3,9 @@ from omg.util import *
 from omg.wad  import TxdefGroup
 from omg      import six
 
+def _init_texturedef(self):
+    self.patches = []
+
 TextureDef = make_struct(
   "TextureDef",
   """Class for texture definitions""",
@@ -12,7 +15,7 @@ TextureDef = make_struct(
    ["height",   'h',  0  ],
    ["dummy2",   'i',  0  ],
    ["npatches", 'h',  0  ]],
-  init_exec = "self.patches = []"
+  init_exec = _init_texturedef
 )
 
 PatchDef = make_struct(
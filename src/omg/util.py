@@ -4,8 +4,12 @@
 """
 
 from __future__  import print_function
+import re
+import sys
 from fnmatch     import fnmatchcase as wccmp, filter as wcinlist
+from fnmatch     import translate as _wctranslate
 from struct      import pack, unpack, calcsize
+from struct      import Struct as _Struct
 from copy        import copy, deepcopy
 from collections import OrderedDict as od
 from omg         import six
@@ -108,6 +112,26 @@ def all(set):
 def inwclist(elem, seq):
     return any(wccmp(elem, x) for x in seq)
 
+def iswc(pattern):
+    """Test if a name contains wildcard characters."""
+    return '*' in pattern or '?' in pattern or '[' in pattern
+
+_wcmatchers = {}
+
+def wcmatcher(patterns):
+    """Return a function that tests if a name matches a wildcard
+    pattern (or any pattern in a list of patterns). The patterns are
+    compiled once, which is a lot faster than calling wccmp in a loop."""
+    if isinstance(patterns, str):
+        patterns = (patterns,)
+    key = tuple(patterns)
+    try:
+        return _wcmatchers[key]
+    except KeyError:
+        regex = "|".join("(?:%s)" % _wctranslate(p) for p in key) or "(?!)"
+        matcher = _wcmatchers[key] = re.compile(regex, re.S).match
+        return matcher
+
 #----------------------------------------------------------------------
 #
 # Functions for processing lump names and other strings
@@ -129,8 +153,10 @@ def zpad(chars):
 def zstrip(chars):
     """
     Return a string representing chars with all trailing null bytes removed.
-    chars can be a string or byte string.
+    chars can be a string, byte string or buffer.
     """
+    if isinstance(chars, memoryview):
+        chars = chars.tobytes()
     if isinstance(chars, bytes):
         chars = str(chars.decode('ascii', 'ignore'))
     
@@ -168,134 +194,165 @@ def pack32(n):
     """Convert a Python int to a packed signed long (4 bytes)"""
     return pack('<i', n)
 
+def iter_unpack(packer, buffer):
+    """Yield the records of a buffer of packed records, like
+    packer.iter_unpack (which Python 2 lacks) for a struct.Struct."""
+    if hasattr(packer, "iter_unpack"):
+        return packer.iter_unpack(buffer)
+    return (packer.unpack_from(buffer, pos)
+            for pos in range(0, len(buffer), packer.size))
+
 
 #----------------------------------------------------------------------
 #
 # A tool that can generate "Struct" classes for packing, unpacking, and
 # representing the unpacked form of binary data.
 #
-# If this code looks ugly, be happy you didn't see the
-# original version...
+# The classes are built directly, without generating source code.
+# Fields are kept in __slots__ and each class packs and unpacks through
+# one precompiled struct.Struct.
 #
 
-# Template for struct class generation
-_struct_template = '''
-class Struct(object):
-    """%(doc)s"""
-
-    _fmtsize = %(fmtsize)i
-    _fmt  = %(fmt)r
-
-    def __init__(self, %(initargs)s, bytes=None):
-        if bytes:
-            from omg.util import zstrip, safe_name
-            from struct import unpack
-            %(unpackexpr)s
-        else:
-            %(initbody)s
-        %(init_exec)s
-
-    def __getattribute__(self, name):
-        return object.__getattribute__(self, name)
-
-    def pack(self):
-        from omg.util import zpad, safe_name
-        from struct import pack
-        return %(packexpr)s
-
-%(flagdefs)s
-
-Struct.__name__ = %(name)r
-'''
-
-# Template for struct flag property
-_flagproperty = '''
-    def get_%s(self):
-        return %s((self.%s >> %i) & %i)
-    def set_%s(self, value):
-        self.%s &= %i
-        if value is not None and (isinstance(value, bool) or 0 <= value <= %i):
-            self.%s |= (int(value) << %i)
-        elif value:
-            raise ValueError("%s must be between 0 and %i")
-    
-    %s = property(get_%s, set_%s)'''
-
 def make_property(name, bit, size=1, type=bool, var="flags"):
     """Helper function for make_struct which defines properties based on
     bit fields. This is called automatically for "flags" when passing a 
-    list of flags to make_struct, but can also be added to init_exec to
-    handle flags in other variables if needed."""
+    list of flags to make_struct, but the returned property can also be
+    added to a struct class to handle flags in other variables if needed."""
     
     getmask = (1 << size) - 1
     setmask = 0xFFFF ^ (getmask << bit)
-    
-    return _flagproperty % (name, type.__name__, var, bit, getmask,
-                            name, var, setmask, getmask, var, bit, name, getmask,
-                            name, name, name)
 
-def _structdef(name, doc, fields, flags=None, init_exec=""):
-    """Helper function for make_struct. Needed because Python doesn't
-    like compile() and exec in the place when there are unknown
-    variables floating around... (?)"""
+    def get_flag(self):
+        return type((getattr(self, var) >> bit) & getmask)
 
-    extra  = [f for f in fields if f[1] == 'x']
-    fields = [f for f in fields if f[1] != 'x']
-
-    fmt = "<" + "".join(f[1] for f in fields)
-    fmtsize = calcsize(fmt)
-
-    # properties for easy access to the 'flags' bit field
-    flagdefs = ""
-    if flags:
-        i = 0
-        for f in flags:
-            if f is None:
-                i += 1
-                pass
-            elif isinstance(f, str):
-                flagdefs += make_property(f, i)
-                i += 1
-            elif isinstance(f, tuple) and len(f) == 2:
-                propname, size = f
-                flagdefs += make_property(propname, i, size, int if size > 1 else bool)
-                i += size
-            else:
-                raise TypeError("flag must be a string (name), tuple (name, size), or None")
-    
-    if init_exec: init_exec += ";"
-    init_exec += '; '.join("self.%s=%s" % (f[0], f[0]) for f in extra)
-
-    # example:  x=0, y=0, foo="BAR"
-    initargs = ', '.join(f[0] + "=" + repr(f[2]) for f in fields+extra)
-
-    # example:  self.x, self.y, self.foo = unpack('hh8s', bytes);
-    #           self.foo = safe_name(zstrip(self.foo))
-    unpackexpr =  ', '.join('self.'+f[0] for f in fields)
-    unpackexpr += (" = unpack(%r, bytes); " % fmt)
-    unpackexpr += "; ".join("self.%s=safe_name(zstrip(self.%s))" % \
-        (f[0], f[0]) for f in fields if 's' in f[1])
-
-    # example:  self.x=x; self.y=y; self.foo=foo
-    initbody = "; ".join("self.%s=%s" % (f[0], f[0]) for f in fields)
-
-    # example:  pack()
-    packs = []
-    for f in fields:
-        if 's' in f[1]:
-            packs.append("zpad(safe_name(self.%s))" % f[0])
+    def set_flag(self, value):
+        setattr(self, var, getattr(self, var) & setmask)
+        if value is not None and (isinstance(value, bool) or 0 <= value <= getmask):
+            setattr(self, var, getattr(self, var) | (int(value) << bit))
+        elif value:
+            raise ValueError("%s must be between 0 and %i" % (name, getmask))
+
+    return property(get_flag, set_flag)
+
+def _flagdefs(flags):
+    """Helper function for make_struct. Returns a dict of flag
+    properties for the 'flags' bit field."""
+    flagdefs = {}
+    i = 0
+    for f in flags:
+        if f is None:
+            i += 1
+        elif isinstance(f, str):
+            flagdefs[f] = make_property(f, i)
+            i += 1
+        elif isinstance(f, tuple) and len(f) == 2:
+            propname, size = f
+            flagdefs[propname] = make_property(propname, i, size, int if size > 1 else bool)
+            i += size
         else:
-            packs.append("self.%s" % f[0])
-    packexpr = ("pack(%r, " % fmt) + ', '.join(packs) + ")"
+            raise TypeError("flag must be a string (name), tuple (name, size), or None")
+    return flagdefs
 
-    s = _struct_template % locals()
+def make_struct(name, doc, fields, flags=None, init_exec=None):
+    """Create a Struct class according to the given format.
 
-    # print(s.replace("Struct", name))
-    return compile(s, "<struct>", "exec")
+    fields is a list of [name, format, default] lists. Fields with the
+    format 'x' are kept by instances but not packed. flags lists the
+    names of bits in a 'flags' field, see make_property. init_exec is an
+    optional function which is called with each new instance; instances
+    of such classes also accept attributes other than their fields.
 
-def make_struct(*args, **kwargs):
-    """Create a Struct class according to the given format"""
-    namespace = {}
-    
-    exec(_structdef(*args, **kwargs), namespace)
-    return namespace['Struct']
+    Instances are created from field values, or unpacked with the
+    bytes keyword. The classmethods unpack_many and pack_many convert
+    whole buffers of records at once."""
+
+    extra  = [f for f in fields if f[1] == 'x']
+    fields = [f for f in fields if f[1] != 'x']
+
+    packer = _Struct("<" + "".join(f[1] for f in fields))
+    field_names = tuple(f[0] for f in fields)
+    all_names = field_names + tuple(f[0] for f in extra)
+    defaults = tuple(f[2] for f in fields + extra)
+    extra_defaults = defaults[len(fields):]
+    positions = dict((n, i) for i, n in enumerate(all_names))
+    # positions of the name fields, which need zero-padding
+    name_fields = tuple(i for i, f in enumerate(fields) if 's' in f[1])
+
+    def decode(values, cache):
+        values = list(values)
+        for i in name_fields:
+            # most names repeat, decode each distinct name once
+            chars = values[i]
+            if chars not in cache:
+                cache[chars] = safe_name(zstrip(chars))
+            values[i] = cache[chars]
+        return values
+
+    def encode(self):
+        values = [getattr(self, n) for n in field_names]
+        for i in name_fields:
+            values[i] = six.b(safe_name(values[i]))
+        return values
+
+    def __init__(self, *args, **kwargs):
+        data = kwargs.pop("bytes", None)
+        if len(args) > len(all_names):
+            raise TypeError("%s takes at most %i arguments" % (name, len(all_names)))
+        values = list(defaults)
+        values[:len(args)] = args
+        for key, value in kwargs.items():
+            if key not in positions:
+                raise TypeError("%s got an unexpected keyword argument %r" % (name, key))
+            values[positions[key]] = value
+        if data:
+            values[:len(field_names)] = decode(packer.unpack(data), {})
+        for n, value in zip(all_names, values):
+            setattr(self, n, value)
+        if init_exec:
+            init_exec(self)
+
+    def pack(self):
+        return packer.pack(*encode(self))
+
+    @classmethod
+    def unpack_many(cls, buffer):
+        """Unpack a buffer of packed records into a list of instances."""
+        new = cls.__new__
+        extra_names = all_names[len(field_names):]
+        cache = {}
+        objs = []
+        for values in iter_unpack(packer, buffer):
+            if name_fields:
+                values = decode(values, cache)
+            obj = new(cls)
+            for n, value in zip(field_names, values):
+                setattr(obj, n, value)
+            for n, value in zip(extra_names, extra_defaults):
+                setattr(obj, n, value)
+            if init_exec:
+                init_exec(obj)
+            objs.append(obj)
+        return objs
+
+    @classmethod
+    def pack_many(cls, objs):
+        """Pack a sequence of instances into one bytes object."""
+        return b"".join([packer.pack(*encode(obj)) for obj in objs])
+
+    namespace = {
+        # the module defining the struct, so instances can be pickled
+        "__module__": sys._getframe(1).f_globals.get("__name__", __name__),
+        "__doc__": doc,
+        "__slots__": all_names + (("__dict__",) if init_exec else ()),
+        "__init__": __init__,
+        "pack": pack,
+        "unpack_many": unpack_many,
+        "pack_many": pack_many,
+        "_fmt": packer.format,
+        "_fmtsize": packer.size,
+        "_struct": packer,
+        "_fields": field_names,
+        "_field_formats": tuple(f[1] for f in fields),
+    }
+    namespace.update(_flagdefs(flags or ()))
+    return type(name, (object,), namespace)
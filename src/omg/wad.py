@@ -1,8 +1,9 @@
 import os, glob
 import omg.palette
+from omg import six
 from omg.lump  import *
 from omg.util import *
-from omg.wadio import WadIO
+from omg.wadio import WadIO, _maptail
 
 class LumpGroup(OrderedDict):
     """A dict-like object for holding a group of lumps"""
@@ -38,6 +39,14 @@ class LumpGroup(OrderedDict):
             name = fixname(os.path.basename(p[:p.rfind('.')]))
             self[name] = self.lumptype(from_file=p)
 
+    def load_lump(self, wadio, id, lazy=False, lumptype=None):
+        """Create a lump of this group's lump type (or the given type)
+        from an entry of a WadIO object. If lazy is true, the data
+        is only read when first accessed."""
+        lump = (lumptype or self.lumptype)()
+        lump.from_wadio(wadio, id, lazy)
+        return lump
+
     def save_wadio(self, wadio, use_free=True):
         """Save to a WadIO object.
         
@@ -69,9 +78,13 @@ class MarkerGroup(LumpGroup):
         # In case group opens with XX_ and ends with X_
         self.abssuffix = self.config + "_END"
 
-    def load_wadio(self, wadio):
+    def load_wadio(self, wadio, read=True, lazy=False):
         """Load all matching lumps that have not already
-        been flagged as read from the given WadIO object."""
+        been flagged as read from the given WadIO object.
+
+        If read is false, matching lumps are only flagged as read
+        without loading their data. If lazy is true, lump data is
+        read on first access instead."""
         inside = False
         startedwith, endswith = "", ""
         for i in range(len(wadio.entries)):
@@ -83,8 +96,8 @@ class MarkerGroup(LumpGroup):
                 if wccmp(name, endswith) or wccmp(name, self.abssuffix):
                     inside = False
                 else:
-                    if wadio.entries[i].size != 0:
-                        self[name] = self.lumptype(wadio.read(i))
+                    if read and wadio.entries[i].size != 0:
+                        self[name] = self.load_lump(wadio, i, lazy)
                 wadio.entries[i].been_read = True
             else:
                 # print name, self.prefix, wccmp(name, self.prefix)
@@ -94,6 +107,12 @@ class MarkerGroup(LumpGroup):
                     inside = True
                     wadio.entries[i].been_read = True
 
+    def load_entries(self, wadio, indices, lazy=False):
+        """Load the lumps at the given indices of a WadIO object,
+        as classified by classify_entries."""
+        for i in indices:
+            self[wadio.entries[i].name] = self.load_lump(wadio, i, lazy)
+
     def save_wadio(self, wadio, use_free=True):
         """Save to a WadIO object.
         
@@ -112,9 +131,13 @@ class HeaderGroup(LumpGroup):
     def __init2__(self):
         self.tail = self.config
 
-    def load_wadio(self, wadio):
+    def load_wadio(self, wadio, read=True, lazy=False):
         """Load all matching lumps that have not already
-        been flagged as read from the given WadIO object."""
+        been flagged as read from the given WadIO object.
+
+        If read is false, matching lumps are only flagged as read
+        without loading their data. If lazy is true, lump data is
+        read on first access instead."""
         numlumps = len(wadio.entries)
         i = 0
         while i < numlumps:
@@ -129,18 +152,31 @@ class HeaderGroup(LumpGroup):
                and inwclist(wadio.entries[i + 1].name, self.tail) \
                and inwclist(wadio.entries[i + 2].name, self.tail):
                 added = True
-                self[name] = NameGroup()
-                self[name]["_HEADER_"] = Lump(wadio.read(i))
+                if read:
+                    self[name] = NameGroup()
+                    self[name]["_HEADER_"] = self.load_lump(wadio, i, lazy, Lump)
                 wadio.entries[i].been_read = True
                 i += 1
                 while i < numlumps and inwclist(wadio.entries[i].name, self.tail):
-                    self[name][wadio.entries[i].name] = \
-                        self.lumptype(wadio.read(i))
+                    if read:
+                        self[name][wadio.entries[i].name] = \
+                            self.load_lump(wadio, i, lazy)
                     wadio.entries[i].been_read = True
                     i += 1
             if not added:
                 i += 1
 
+    def load_entries(self, wadio, runs, lazy=False):
+        """Load the (header index, tail indices) runs of lumps from a
+        WadIO object, as classified by classify_entries."""
+        for header, tail in runs:
+            name = wadio.entries[header].name
+            self[name] = NameGroup()
+            self[name]["_HEADER_"] = self.load_lump(wadio, header, lazy, Lump)
+            for i in tail:
+                self[name][wadio.entries[i].name] = \
+                    self.load_lump(wadio, i, lazy)
+
     def save_wadio(self, wadio, use_free=True):
         """Save to a WadIO object.
         
@@ -166,18 +202,29 @@ class NameGroup(LumpGroup):
     def __init2__(self):
         self.names = self.config
 
-    def load_wadio(self, wadio):
+    def load_wadio(self, wadio, read=True, lazy=False):
         """Load all matching lumps that have not already
-        been flagged as read from the given WadIO object."""
+        been flagged as read from the given WadIO object.
+
+        If read is false, matching lumps are only flagged as read
+        without loading their data. If lazy is true, lump data is
+        read on first access instead."""
         inside = False
         for i in range(len(wadio.entries)):
             if wadio.entries[i].been_read:
                 continue
             name = wadio.entries[i].name
             if inwclist(name, self.names):
-                self[name] = self.lumptype(wadio.read(i))
+                if read:
+                    self[name] = self.load_lump(wadio, i, lazy)
                 wadio.entries[i].been_read = True
 
+    def load_entries(self, wadio, indices, lazy=False):
+        """Load the lumps at the given indices of a WadIO object,
+        as classified by classify_entries."""
+        for i in indices:
+            self[wadio.entries[i].name] = self.load_lump(wadio, i, lazy)
+
 class TxdefGroup(NameGroup):
     """Group for texture definition lumps"""
     def __init2__(self):
@@ -195,11 +242,7 @@ class TxdefGroup(NameGroup):
 # This defines the default structure for WAD files.
 #
 
-# First some lists...
-_maptail    = ['THINGS',   'LINEDEFS', 'SIDEDEFS', # Must be in order
-               'VERTEXES', 'SEGS',     'SSECTORS',
-               'NODES',    'SECTORS',  'REJECT',
-               'BLOCKMAP', 'BEHAVIOR', 'SCRIPT*']
+# First some lists... (_maptail comes from omg.wadio)
 _glmaptail    = ['GL_VERT', 'GL_SEGS', 'GL_SSECT', 'GL_NODES']
 _graphics     = ['TITLEPIC', 'CWILV*', 'WI*', 'M_*',
                  'INTERPIC', 'BRDR*',  'PFUB?', 'ST*',
@@ -228,13 +271,131 @@ write_order = ['data', 'colormaps', 'maps', 'glmaps', 'txdefs',
     'sounds', 'music', 'graphics', 'sprites', 'patches', 'flats',
     'ztextures']
 
+
+def _group_kind(group):
+    """Return 0, 1 or 2 for marker, header and name groups that load
+    lumps the standard way, or None for groups with custom loading."""
+    for kind, cls in enumerate((MarkerGroup, HeaderGroup, NameGroup)):
+        if isinstance(group, cls):
+            load = six.get_unbound_function(type(group).load_wadio)
+            if load is six.get_unbound_function(cls.load_wadio):
+                return kind
+    return None
+
+def can_classify(groups):
+    """Test if classify_entries can be used for a list of groups, i.e.
+    they all load lumps the standard way and are in structure order
+    (marker groups first, then header groups, then name groups)."""
+    kinds = [_group_kind(g) for g in groups]
+    return None not in kinds and kinds == sorted(kinds)
+
+def classify_entries(entries, groups):
+    """Assign WadIO entries to groups in a single pass over the
+    directory. The result is the same as calling load_wadio for each
+    group in turn: marker regions of earlier groups take precedence,
+    header groups then claim their header-tail runs, and name groups
+    take the remaining lumps. Entries already flagged as read are
+    skipped; all classified entries are flagged as read.
+
+    Returns a list holding, for each group, the indices of its lumps
+    (or (header index, tail indices) runs for header groups) in load
+    order. The groups must satisfy can_classify."""
+    markers = [g for g in groups if isinstance(g, MarkerGroup)]
+    headers = [g for g in groups if isinstance(g, HeaderGroup)]
+    namers  = [g for g in groups if _group_kind(g) == 2]
+    prefixes  = [wcmatcher(g.prefix) for g in markers]
+    suffixes  = [wcmatcher(g.abssuffix) for g in markers]
+    tails     = [wcmatcher(g.tail) for g in headers]
+    namelists = [wcmatcher(g.names) for g in namers]
+
+    # Wildcards are matched once per distinct name. For each name,
+    # store the first marker group it starts, whether it is a tail
+    # lump of each header group, and the first name group it matches.
+    traits = {}
+    def traits_of(name):
+        try:
+            return traits[name]
+        except KeyError:
+            start = None
+            for k, match in enumerate(prefixes):
+                if match(name):
+                    start = k
+                    break
+            named = None
+            for k, match in enumerate(namelists):
+                if match(name):
+                    named = k
+                    break
+            t = traits[name] = (start, [bool(m(name)) for m in tails], named)
+            return t
+
+    n = len(entries)
+    names = [e.name for e in entries]
+    read = [e.been_read for e in entries]
+    entry_traits = [traits_of(name) for name in names]
+    marker_items = [[] for g in markers]
+    header_items = [[] for g in headers]
+    name_items   = [[] for g in namers]
+
+    # Marker region state: group index and end marker matcher
+    region = None
+    region_end = None
+    # Header group state: end of the current run, and for each entry
+    # the first header group that has claimed it (as part of a run
+    # that may extend past the current position)
+    run_end = [0] * len(headers)
+    header_claim = [len(headers)] * n
+
+    for i in range(n):
+        name = names[i]
+        start, is_tail, named = entry_traits[i]
+        # Marker groups. An earlier group's start marker cuts short the
+        # region of a later group, since that group is loaded first.
+        claimed = read[i]
+        if claimed:
+            region = None
+        elif region is not None and (start is None or start >= region):
+            if region_end(name) or suffixes[region](name):
+                region = None
+            elif entries[i].size != 0:
+                marker_items[region].append(i)
+            claimed = True
+        elif start is not None:
+            region = start
+            region_end = wcmatcher(name.replace("START", "END"))
+            claimed = True
+
+        # Header groups. A run claims its tail lumps even if they have
+        # been read, but only later groups see them as claimed.
+        for h in range(len(headers)):
+            if i < run_end[h] or claimed or header_claim[i] < h:
+                continue
+            if i < n - 2 and entry_traits[i+1][1][h] and entry_traits[i+2][1][h]:
+                j = i + 1
+                while j < n and entry_traits[j][1][h]:
+                    j += 1
+                header_items[h].append((i, list(range(i + 1, j))))
+                run_end[h] = j
+                for k in range(i, j):
+                    header_claim[k] = min(header_claim[k], h)
+
+        # Name groups get whatever is left
+        if claimed or header_claim[i] < len(headers):
+            entries[i].been_read = True
+        elif named is not None:
+            name_items[named].append(i)
+            entries[i].been_read = True
+
+    items = iter(marker_items + header_items + name_items)
+    return [next(items) for g in groups]
+
 class WAD:
     """A memory-resident, abstract representation of a WAD file. Lumps
     are stored in subsections of the WAD. Loading/saving and handling
     the sections follows the structure specification.
 
     Initialization:
-    new = WAD([from_file, structure])
+    new = WAD([from_file, structure, sections])
 
     Source may be a string representing a path to a file to load from.
     By default, an empty WAD is created.
@@ -242,22 +403,37 @@ class WAD:
     Structure may be used to specify a custom lump
     categorization/loading configuration.
 
+    Sections may be used to only load the named sections
+    (e.g. ['maps']); lumps of all other sections are skipped
+    without being read.
+
+    If lazy is true, lump data is only read from the file when it is
+    first accessed, so loading a WAD merely costs reading its
+    directory. The file is kept open while lazily loaded lumps use it.
+
     Member data:
         .structure     Structure definition.
+        .sections      Names of the sections to load, or None for all
+        .lazy          Whether lump data is read on first access
         .palette       Palette
         .sprites, etc  Sections containing lumps, as specified by
                        the structure definition"""
 
-    def __init__(self, from_file=None, structure=defstruct):
+    def __init__(self, from_file=None, structure=defstruct, sections=None,
+                 lazy=False):
         """Create a new WAD. The optional `source` argument may be a
         string specifying a path to a file or a WadIO object.
         If omitted, an empty WAD is created. A WADStructure object
         may be passed as the `structure` argument to apply a custom
         section structure. By default, the structure specified in the
-        defdata module is used."""
+        defdata module is used. A list of section names may be passed
+        as the `sections` argument to only load those sections, and
+        `lazy` defers reading lump data until it is accessed."""
         self.__category = 'root'
         self.palette = omg.palette.default
         self.structure = structure
+        self.sections = sections
+        self.lazy = lazy
         self.groups = []
         for group_def in self.structure:
             instance = group_def[0](*tuple(group_def[1:]))
@@ -266,9 +442,17 @@ class WAD:
         if from_file:
             self.from_file(from_file)
 
-    def from_file(self, source):
+    def from_file(self, source, sections=None, lazy=None):
         """Load contents from a file. `source` may be a string
-        specifying a path to a file or a WadIO object."""
+        specifying a path to a file or a WadIO object.
+
+        `sections` optionally lists the names of the sections to load,
+        and defaults to the sections given when creating the WAD. Lumps
+        belonging to other sections are still classified (so that the
+        grouping of the loaded sections does not change) but their
+        data is not read.
+
+        `lazy` defaults to the value given when creating the WAD."""
         if isinstance(source, WadIO):
             w = source
         elif isinstance(source, str):
@@ -276,8 +460,24 @@ class WAD:
             w = WadIO(source)
         else:
             raise TypeError("Expected WadIO or file path string")
-        for group in self.groups:
-            group.load_wadio(w)
+        if sections is None:
+            sections = self.sections
+        if lazy is None:
+            lazy = self.lazy
+        if can_classify(self.groups):
+            items = classify_entries(w.entries, self.groups)
+            for group, group_items in zip(self.groups, items):
+                if sections is None or group._name in sections:
+                    group.load_entries(w, group_items, lazy)
+        else:
+            for group in self.groups:
+                read = sections is None or group._name in sections
+                if read and not lazy:
+                    # groups with their own load_wadio may not take
+                    # the other arguments
+                    group.load_wadio(w)
+                else:
+                    group.load_wadio(w, read, lazy)
 
     def to_file(self, filename):
         """Save contents to a WAD file. Caution: if a file with the given name
@@ -1,4 +1,4 @@
-import os, hashlib, time
+import os, bisect, hashlib, mmap, time
 from omg.util import *
 
 Header = make_struct(
@@ -19,6 +19,13 @@ Entry = make_struct(
 )
 
 
+# Names of the lumps that follow a map header, in order
+_maptail    = ['THINGS',   'LINEDEFS', 'SIDEDEFS',
+               'VERTEXES', 'SEGS',     'SSECTORS',
+               'NODES',    'SECTORS',  'REJECT',
+               'BLOCKMAP', 'BEHAVIOR', 'SCRIPT*']
+
+
 # WadIO.open() behaves just like open(). Sometimes it is
 # useful to specifically either open an existing file
 # or create a new one.
@@ -64,18 +71,33 @@ class WadIO:
     is that changes can't be undone (so back up first!) and that
     file content will get fragmented when you edit lumps (unused
     space will appear). To get rid of the wasted space, use the
-    rewrite() method (which rewrites the entire file)."""
+    rewrite() method (which rewrites the entire file).
+
+    If use_mmap is true, the file is memory-mapped and read() returns
+    read-only memoryview slices into the mapping instead of copying
+    the data. This avoids doubling memory use when analysing large
+    WADs, and lets processes reading the same file share the page
+    cache. The views stay valid after the WadIO object is closed.
+    Where the mapping can't be viewed (Python 2), data is read from
+    the file as usual."""
 
-    def __init__(self, openfrom=None):
+    def __init__(self, openfrom=None, use_mmap=False):
         self.basefile = None
         self.issafe = True
         self.header = Header()
         self.entries = []
+        self.names = None
+        self.names_len = 0
+        self.free = None
+        self.overlaps = False
+        self.use_mmap = use_mmap
+        self.mapping = None
         if openfrom is not None:
             self.open(openfrom)
 
     def __del__(self):
         if self.basefile:
+            self.unmap()
             self.basefile.close()
 
     def open(self, filename):
@@ -100,6 +122,8 @@ class WadIO:
             self.basefile.seek(h.dir_ptr)
             self.entries = [Entry(bytes=self.basefile.read(Entry._fmtsize)) \
                 for i in range(h.dir_len)]
+            self.names = None
+            self.free = None
         # Create new
         else:
             self.basefile = open(filename, 'w+b')
@@ -113,9 +137,59 @@ class WadIO:
         if not self.issafe:
             raise IOError(\
                 "closing a modified file may corrupt it. use save() first")
+        self.unmap()
         self.basefile.close()
         self.basefile = None
 
+    def map(self, size=0):
+        """Return a memory mapping of the file which covers at least
+        `size` bytes, (re)mapping the file if needed."""
+        assert self.basefile
+        if self.mapping is None or len(self.mapping) < size:
+            self.unmap()
+            self.basefile.flush()
+            self.mapping = mmap.mmap(self.basefile.fileno(), 0,
+                                     access=mmap.ACCESS_READ)
+        return self.mapping
+
+    def unmap(self):
+        """Release the memory mapping of the file, if any. A mapping
+        that is still referenced by memoryviews is released once the
+        last view is gone."""
+        if self.mapping is not None:
+            try:
+                self.mapping.close()
+            except BufferError:
+                pass
+            self.mapping = None
+
+    def reindex(self):
+        """Rebuild the table that maps entry names to the indices of
+        the entries with that name. This is done automatically by the
+        methods of this class; call it after renaming items of
+        .entries directly."""
+        self.names = {}
+        for i, entry in enumerate(self.entries):
+            self.names.setdefault(entry.name, []).append(i)
+        self.names_len = len(self.entries)
+
+    def name_index(self):
+        """Return the name -> list of indices table, rebuilding it if
+        it is out of date."""
+        if self.names is None or self.names_len != len(self.entries):
+            self.reindex()
+        return self.names
+
+    def _shift_names(self, index, delta):
+        """Add delta to the indices at or after index in the name
+        table, after inserting or removing an entry."""
+        for indices in self.names.values():
+            # the lists are sorted, shift their tails
+            j = len(indices) - 1
+            while j >= 0 and indices[j] >= index:
+                indices[j] += delta
+                j -= 1
+
     def select(self, id):
         """Return a valid index from a proposed index or entry name, or
         raise LookupError in case of failure."""
@@ -125,8 +199,14 @@ class WadIO:
                 return id
             raise LookupError
         elif isinstance(id, str):
+            if not iswc(id):
+                indices = self.name_index().get(id)
+                if indices:
+                    return indices[0]
+                raise LookupError
+            match = wcmatcher(id)
             for i in range(len(self.entries)):
-                if wccmp(self.entries[i].name, id):
+                if match(self.entries[i].name):
                     return i
             raise LookupError
         raise TypeError
@@ -149,26 +229,92 @@ class WadIO:
         assert self.basefile
         if start is None: start = 0
         if end   is None: end   = len(self.entries)
+        if not iswc(id):
+            return [i for i in self.name_index().get(id, ()) \
+                    if start <= i < end]
+        match = wcmatcher(id)
         return [i for i in range(start, end) if \
-                wccmp(self.entries[i].name, id)]
+                match(self.entries[i].name)]
 
     def read(self, id):
-        """Read an entry and return the data as a binary string."""
+        """Read an entry and return the data as a binary string (or
+        a memoryview if the file is memory-mapped)."""
         assert self.basefile
-        id = self.select(id)
-        self.basefile.seek(self.entries[id].ptr)
-        return self.basefile.read(self.entries[id].size)
+        entry = self.entries[self.select(id)]
+        return self.read_at(entry.ptr, entry.size)
+
+    def find_maps(self, pattern="*", tail=None):
+        """Find maps using the directory alone, without reading any
+        lump data. A map is a header entry followed by at least two
+        tail entries (by default, the standard map lumps).
+
+        Returns an ordered dict mapping the names of maps that match
+        the pattern (wildcards are supported) to ordered dicts of
+        their lump names and entry indices. The header's index is
+        stored as "_HEADER_"."""
+        assert self.basefile
+        tail = wcmatcher(tail or _maptail)
+        wanted = wcmatcher(pattern)
+        names = [e.name for e in self.entries]
+        numlumps = len(names)
+        maps = OrderedDict()
+        i = 0
+        while i < numlumps:
+            if i < numlumps - 2 and tail(names[i + 1]) and tail(names[i + 2]):
+                lumps = OrderedDict()
+                lumps["_HEADER_"] = i
+                header = names[i]
+                i += 1
+                while i < numlumps and tail(names[i]):
+                    lumps[names[i]] = i
+                    i += 1
+                if wanted(header):
+                    maps[header] = lumps
+            else:
+                i += 1
+        return maps
+
+    def read_at(self, pos, size):
+        """Read size bytes of data at the given position. A memoryview
+        is returned if the file is memory-mapped."""
+        assert self.basefile
+        if self.use_mmap and size > 0:
+            try:
+                return memoryview(self.map(pos + size))[pos:pos + size]
+            except TypeError:
+                # Python 2 mappings can't be viewed, read copies instead
+                self.unmap()
+                self.use_mmap = False
+        self.basefile.seek(pos)
+        return self.basefile.read(size)
 
     def remove(self, id):
         """Remove an entry."""
         assert self.basefile
-        del (self.entries[self.select(id)])
+        id = self.select(id)
+        names = self.name_index()
+        entry = self.entries[id]
+        names[entry.name].remove(id)
+        if not names[entry.name]:
+            del names[entry.name]
+        del (self.entries[id])
+        self._shift_names(id, -1)
+        self.names_len -= 1
+        if entry.size > 0:
+            self.release(entry.ptr, entry.ptr + entry.size)
         self.issafe = False
 
     def rename(self, id, new):
         """Rename an entry."""
         assert self.basefile
-        self.entries[self.select(id)].name = new[0:8].upper()
+        id = self.select(id)
+        names = self.name_index()
+        old = self.entries[id].name
+        names[old].remove(id)
+        if not names[old]:
+            del names[old]
+        self.entries[id].name = new[0:8].upper()
+        bisect.insort(names.setdefault(self.entries[id].name, []), id)
         self.issafe = False
 
     def write_at(self, pos, data):
@@ -181,6 +327,47 @@ class WadIO:
         self.basefile.seek(0, 2)
         self.basefile.write(data)
 
+    def free_extents(self):
+        """Return the sorted list of [start, end] extents of free space
+        in the file. The list is built from calc_waste() when first
+        needed and then kept up to date as lumps are written, updated
+        and removed."""
+        if self.free is None:
+            space, positions, self.overlaps = self._scan_space()
+            self.free = [list(p) for p in positions]
+        return self.free
+
+    def release(self, start, end):
+        """Mark the space between start and end as free, merging it
+        with adjacent free extents. If some of the space is still in
+        use (e.g. by lumps sharing data), the free extents are
+        recalculated when next needed instead."""
+        if start >= end or self.free is None:
+            return
+        dir_end = self.header.dir_ptr + self.header.dir_len*Entry._fmtsize
+        if start < Header._fmtsize or \
+           (self.header.dir_ptr < end and start < dir_end):
+            self.free = None
+            return
+        # Lumps only share space if the file already had overlapping
+        # lumps when the free extents were built
+        if self.overlaps:
+            for entry in self.entries:
+                if entry.size > 0 and entry.ptr < end and \
+                   start < entry.ptr + entry.size:
+                    self.free = None
+                    return
+        free = self.free
+        i = bisect.bisect_left(free, [start, end])
+        if i > 0 and free[i-1][1] >= start:
+            i -= 1
+            free[i][1] = max(free[i][1], end)
+        else:
+            free.insert(i, [start, end])
+        while i + 1 < len(free) and free[i+1][0] <= free[i][1]:
+            free[i][1] = max(free[i][1], free[i+1][1])
+            del free[i+1]
+
     def write_free(self, data):
         """Write data to empty space in the file, if available,
         otherwise write to the end of the file.
@@ -191,10 +378,15 @@ class WadIO:
         
         # Find the earliest available free space
         # (or, if free space reaches to the end of the file, use it)
-        for p in self.calc_waste()[1]:
+        free = self.free_extents()
+        for i, p in enumerate(free):
             if p[1] - p[0] >= len(data) or p[1] == pos:
                 pos = p[0]
                 self.basefile.seek(pos)
+                if pos + len(data) < p[1]:
+                    p[0] = pos + len(data)
+                else:
+                    del free[i]
                 break
         
         self.basefile.write(data)
@@ -225,8 +417,17 @@ class WadIO:
         
         if index is None:
             self.entries.append(Entry(pos, len(data), name))
+            if self.names is not None and \
+               self.names_len == len(self.entries) - 1:
+                entry = self.entries[-1]
+                self.names.setdefault(entry.name, []).append(len(self.entries) - 1)
+                self.names_len += 1
         else:
+            names = self.name_index()
+            self._shift_names(index, 1)
             self.entries.insert(index, Entry(pos, len(data), name))
+            bisect.insort(names.setdefault(self.entries[index].name, []), index)
+            self.names_len += 1
         self.basefile.flush()
 
     def update(self, id, data):
@@ -235,20 +436,27 @@ class WadIO:
         allocated for the lump."""
         assert self.basefile
         id = self.select(id)
-        if len(data) != self.entries[id].size:
+        entry = self.entries[id]
+        ptr, size = entry.ptr, entry.size
+        if len(data) != size:
             self.issafe = False
         
         if len(data) == 0:
-            self.entries[i].ptr = 0
-        elif len(data) <= self.entries[id].size:
-            self.write_at(self.entries[id].ptr, data)
+            entry.ptr = 0
+            entry.size = 0
+            self.release(ptr, ptr + size)
+        elif len(data) <= size:
+            self.write_at(ptr, data)
+            entry.size = len(data)
+            self.release(ptr + len(data), ptr + size)
         else:
-            # temporarily mark existing entry as free, its current space will
+            # mark existing entry as free, its current space will
             # be combined with any adjacent free space
-            self.entries[id].size = 0
+            entry.size = 0
+            self.release(ptr, ptr + size)
             # write data to end of file or use free space if possible
-            self.entries[id].ptr = self.write_free(data)
-        self.entries[id].size = len(data)
+            entry.ptr = self.write_free(data)
+            entry.size = len(data)
         self.basefile.flush()
 
     def save(self):
@@ -256,10 +464,14 @@ class WadIO:
         assert self.basefile
         if self.issafe: return
         dir = join([e.pack() for e in self.entries])
-        self.header.dir_len = len(self.entries)
+        old_ptr = self.header.dir_ptr
+        old_end = old_ptr + self.header.dir_len*Entry._fmtsize
         self.header.dir_ptr = self.write_free(dir)
+        self.header.dir_len = len(self.entries)
         self.write_at(0, self.header.pack())
         self.basefile.flush()
+        # the old directory is now unused
+        self.release(old_ptr, old_end)
         self.issafe = True
 
     def rewrite(self):
@@ -287,16 +499,24 @@ class WadIO:
         """Returns an (int, list) tuple containing the total amount of
         wasted space in the WAD and a list of (start, end) tuples for
         the spots where the wasted chunks are located."""
+        space, positions, overlaps = self._scan_space()
+        return space, positions
+
+    def _scan_space(self):
+        """Helper for calc_waste. Also returns whether any of the
+        lumps, header and directory share space in the file."""
         assert self.basefile
-        filesize = os.stat(self.basefile.name)[6]
+        self.basefile.seek(0, 2)
+        filesize = self.basefile.tell()
         # Create a list of (start, end) tuples to represent used space
         chunks = []
         # Treat the header and the end of the file as chunks of used space
-        chunks.append((0, 12))
+        chunks.append((0, Header._fmtsize))
         chunks.append((filesize, filesize + 1))
-        # Add to the list the chunks that are occupied by lump data
+        # Add to the list the chunks that are occupied by the directory
+        # as stored in the file, and by lump data
         chunks.append((self.header.dir_ptr, self.header.dir_ptr + \
-            len(self.entries)*Entry._fmtsize))
+            self.header.dir_len*Entry._fmtsize))
         for entry in self.entries:
             if entry.size > 0:
                 chunks.append((entry.ptr, entry.ptr + entry.size))
@@ -304,13 +524,18 @@ class WadIO:
         chunks.sort()
         positions = []
         space = 0
-        for i in range(0, len(chunks)-1):
-            # Check whether the end of the chunk touches the beginning of the
-            # next one. If not, there's wasted space between them.
-            if chunks[i][1] < chunks[i+1][0]:
-                positions.append((chunks[i][1], chunks[i+1][0]))
+        overlaps = False
+        end = chunks[0][1]
+        for i in range(1, len(chunks)):
+            # Check whether the used space so far reaches the beginning of
+            # the next chunk. If not, there's wasted space between them.
+            if end < chunks[i][0]:
+                positions.append((end, chunks[i][0]))
                 space += positions[-1][1] - positions[-1][0]
-        return space, positions
+            elif end > chunks[i][0] and chunks[i][0] < chunks[i][1]:
+                overlaps = True
+            end = max(end, chunks[i][1])
+        return space, positions, overlaps
 
     def info_text(self):
         """Return printable fancy-formatted info about the WAD file."""
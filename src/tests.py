@@ -251,6 +251,100 @@ class TestWADExtractionMethods(unittest.TestCase):
         self.assertEqual(map2_data["medium"]["monster hit points"], 60)
         self.assertEqual(map2_data["hard"]["monster hit points"], 100)
 
+    def test_iter_things_matches_map_editor(self):
+        """Unpacked things match the map editor"""
+        from omg import omg
+        wad = omg.WAD("test.wad")
+        wadio = omg.WadIO("test.wad")
+        for map_name, lumps in wadio.find_maps().items():
+            edit = omg.MapEditor(wad.maps[map_name])
+            expected = [(t.type, t.flags) for t in edit.things]
+            self.assertEqual(list(dmoncommon.iter_things(wadio, lumps)),
+                             expected)
+
+    def test_sum_traits(self):
+        """Trait table totals match per-thing lookups"""
+        from omg import omg
+        wadio = omg.WadIO("test.wad")
+        lumps = wadio.find_maps()["MAP03"]
+        things = list(dmoncommon.iter_things(wadio, lumps))
+        table = dmoncommon.trait_table(True)
+        totals = dmoncommon.sum_traits([t[0] for t in things],
+                                       [t[1] for t in things], table)
+        hard = [t[0] for t in things if t[1] & 4]
+        self.assertEqual(totals["hard"][0],
+            sum(dmoncommon.count_if(dmoncommon.is_hitscanner, t) for t in hard))
+        self.assertEqual(totals["hard"][2],
+            sum(dmoncommon.health_points_of(t, True) for t in hard))
+        types, flags = dmoncommon.thing_columns(wadio, lumps)
+        self.assertEqual(dmoncommon.sum_traits(types, flags, table), totals)
+
+    def test_parallel_jobs(self):
+        """Parallel analysis gives the same results as serial"""
+        options = dmon.docopt(dmon.__doc__, argv=["test.wad"])
+        serial = dmoncommon.extract_statistics(options)
+        options = dmon.docopt(dmon.__doc__, argv=["test.wad", "--jobs", "2"])
+        parallel = dmoncommon.extract_statistics(options)
+        self.assertEqual(parallel, serial)
+
+    def test_batch(self):
+        """Analyse a batch of wads, skipping bad ones"""
+        options = dmon.docopt(dmon.__doc__,
+            argv=["--batch", "test.wad", "missing.wad", "--maps", "MAP01"])
+        filenames = dmoncommon.find_wad_files(options["<path>"])
+        self.assertEqual(filenames, ["test.wad", "missing.wad"])
+        results = list(dmoncommon.extract_batch_statistics(filenames, options))
+        self.assertEqual(results[0][1]["map list"], ["MAP01"])
+        self.assertIsNone(results[0][2])
+        self.assertIsNone(results[1][1])
+        self.assertEqual(results[1][2], "WAD not found")
+
+    def test_result_cache(self):
+        """Cached map counts give the same results"""
+        import shutil
+        import tempfile
+        import dmoncache
+        cache_dir = tempfile.mkdtemp()
+        try:
+            options = dmon.docopt(dmon.__doc__, argv=["test.wad"])
+            expected = dmoncommon.extract_statistics(options)
+            options = dmon.docopt(dmon.__doc__,
+                argv=["test.wad", "--cache", cache_dir])
+            self.assertEqual(dmoncommon.extract_statistics(options), expected)
+            self.assertEqual(dmoncommon.extract_statistics(options), expected)
+            cache = dmoncache.ResultCache(cache_dir)
+            key = dmoncache.cache_key(b"", False, False)
+            self.assertIsNone(cache.get(key))
+            cache.put(key, {"easy": {"monsters": 1}})
+            self.assertEqual(cache.get(key), {"easy": {"monsters": 1}})
+            cache.close()
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_csv_output(self):
+        """Write a CSV row per map and skill"""
+        options = dmon.docopt(dmon.__doc__, argv=["test.wad", "-f", "csv"])
+        wad_data = dmoncommon.extract_statistics(options)
+        lines = dmon.to_csv(wad_data, options).splitlines()
+        self.assertEqual(lines[0].split(",")[:3], ["FILE", "MAP", "SKILL"])
+        self.assertEqual(len(lines), 1 + 3 * len(wad_data["map list"]))
+        self.assertTrue(lines[1].startswith("test.wad,MAP01,easy,"))
+        self.assertEqual(dmon.to_csv(wad_data, options, False).splitlines(),
+                         lines[1:])
+
+    def test_iter_statistics(self):
+        """Streamed maps and running averages match the full extraction"""
+        options = dmon.docopt(dmon.__doc__, argv=["test.wad"])
+        wad_stats = dmoncommon.extract_statistics(options)
+        totals = dmoncommon.new_running_totals()
+        streamed = list(dmoncommon.iter_statistics(options, totals))
+        self.assertEqual([name for name, _ in streamed],
+                         wad_stats["map list"])
+        for map_name, map_data in streamed:
+            self.assertEqual(map_data, wad_stats["data"][map_name])
+        sums, averages = dmoncommon.averages_of(totals)
+        self.assertEqual(averages, wad_stats["data"]["AVERAGES"])
+
 
 class TestDerivingMethods(unittest.TestCase):
 
@@ -391,6 +485,539 @@ class TestDerivingMethods(unittest.TestCase):
         self.assertEqual(avg["easy"][constants.SHELL_DMG_COL], expected_shell)
 
 
+class TestWADLoading(unittest.TestCase):
+
+    def test_load_sections(self):
+        """Load only the requested WAD sections"""
+        from omg import omg
+        full = omg.WAD("test.wad")
+        maps_only = omg.WAD("test.wad", sections=["maps"])
+        self.assertEqual(maps_only.maps.keys(), full.maps.keys())
+        self.assertEqual(maps_only.maps["MAP01"]["THINGS"].data,
+                         full.maps["MAP01"]["THINGS"].data)
+        self.assertEqual(len(maps_only.glmaps), 0)
+        self.assertEqual(len(maps_only.data), 0)
+
+    def test_load_lazy(self):
+        """Read lump data on first access"""
+        from omg import omg
+        full = omg.WAD("test.wad")
+        lazy = omg.WAD("test.wad", lazy=True)
+        things = lazy.maps["MAP01"]["THINGS"]
+        self.assertIsNone(things._data)
+        self.assertEqual(things.data, full.maps["MAP01"]["THINGS"].data)
+        things.unload()
+        self.assertIsNone(things._data)
+        self.assertEqual(things.copy().data, full.maps["MAP01"]["THINGS"].data)
+
+    def test_custom_group_loader(self):
+        """Load groups whose load_wadio takes only the WadIO object"""
+        from omg import omg
+        from omg.wad import NameGroup, defstruct
+        loaded = []
+        class PlaypalGroup(NameGroup):
+            def load_wadio(self, wadio):
+                loaded.append(wadio)
+                NameGroup.load_wadio(self, wadio)
+        structure = [d for d in defstruct if d[1] != "data"] + \
+            [[PlaypalGroup, "data", omg.Lump, ["*"]]]
+        wad = omg.WAD("test.wad", structure=structure)
+        self.assertEqual(len(loaded), 1)
+        self.assertEqual(wad.data.keys(), omg.WAD("test.wad").data.keys())
+
+    def test_classify_entries(self):
+        """Classify directory entries like the section loaders"""
+        from omg import omg
+        classified = omg.WAD("test.wad")
+        sequential = omg.WAD()
+        wadio = omg.WadIO("test.wad")
+        for group in sequential.groups:
+            group.load_wadio(wadio)
+        for a, b in zip(classified.groups, sequential.groups):
+            self.assertEqual(a.keys(), b.keys())
+        self.assertEqual(classified.glmaps["GL_MAP01"].keys(),
+                         sequential.glmaps["GL_MAP01"].keys())
+
+    def test_load_mmap(self):
+        """Read lump data from a memory-mapped WAD"""
+        from omg import omg
+        full = omg.WAD("test.wad")
+        wadio = omg.WadIO("test.wad", use_mmap=True)
+        mapped = omg.WAD(wadio)
+        things = mapped.maps["MAP01"]["THINGS"]
+        self.assertIsInstance(things.data,
+                              memoryview if wadio.use_mmap else bytes)
+        self.assertEqual(things.data, full.maps["MAP01"]["THINGS"].data)
+        edit = omg.MapEditor(mapped.maps["MAP01"])
+        self.assertEqual(len(edit.things), len(things.data) // 10)
+
+    def test_wadio_name_index(self):
+        """Keep the name index in sync with directory edits"""
+        import os
+        import random
+        import shutil
+        import tempfile
+        from omg import omg
+        directory = tempfile.mkdtemp()
+        try:
+            wadio = omg.WadIO(os.path.join(directory, "names.wad"))
+            for i in range(40):
+                wadio.insert("LUMP%d" % (i % 7), b"data")
+            names = wadio.name_index()
+            rng = random.Random(4)
+            for step in range(300):
+                choice = rng.randrange(3)
+                if choice == 0 or len(wadio.entries) < 2:
+                    wadio.insert("LUMP%d" % rng.randrange(9), b"data",
+                                 index=rng.randrange(len(wadio.entries)))
+                elif choice == 1:
+                    wadio.remove(rng.randrange(len(wadio.entries)))
+                else:
+                    wadio.rename(rng.randrange(len(wadio.entries)),
+                                 "LUMP%d" % rng.randrange(9))
+                # updated in place, not dropped and rebuilt
+                self.assertIs(wadio.name_index(), names)
+                rebuilt = {}
+                for i, entry in enumerate(wadio.entries):
+                    rebuilt.setdefault(entry.name, []).append(i)
+                self.assertEqual(names, rebuilt)
+            for name, indices in rebuilt.items():
+                self.assertEqual(wadio.find(name), indices[0])
+                self.assertEqual(wadio.multifind(name), indices)
+            wadio.save()
+            wadio.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_wadio_free_extents(self):
+        """Reuse free space without touching the lumps in use"""
+        import os
+        import random
+        import shutil
+        import tempfile
+        from omg import omg
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "free.wad")
+            wadio = omg.WadIO(path)
+            contents = {}
+            rng = random.Random(5)
+            for step in range(400):
+                choice = rng.randrange(4)
+                data = bytes(bytearray([step % 256])) * rng.randrange(0, 200)
+                if choice == 0 or not contents:
+                    name = "L%d" % step
+                    wadio.insert(name, data)
+                    contents[name] = data
+                elif choice == 1:
+                    name = rng.choice(sorted(contents))
+                    wadio.update(name, data)
+                    contents[name] = data
+                elif choice == 2:
+                    name = rng.choice(sorted(contents))
+                    wadio.remove(name)
+                    del contents[name]
+                else:
+                    wadio.save()
+                free = wadio.free_extents()
+                for start, end in free:
+                    self.assertLess(start, end)
+                    for entry in wadio.entries:
+                        if entry.size > 0:
+                            self.assertFalse(entry.ptr < end and
+                                             start < entry.ptr + entry.size)
+                total, positions = wadio.calc_waste()
+                self.assertEqual(sum(end - start for start, end in free), total)
+                self.assertEqual([tuple(p) for p in free], positions)
+            wadio.save()
+            wadio.close()
+            wadio = omg.WadIO(path)
+            self.assertEqual(len(wadio.entries), len(contents))
+            for name, data in contents.items():
+                self.assertEqual(wadio.read(name), data)
+            wadio.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_load_mmap_fallback(self):
+        """Read copies of lump data where the mapping can't be viewed"""
+        from omg import omg
+        options = dmon.docopt(dmon.__doc__, argv=["test.wad"])
+        expected = dmoncommon.extract_statistics(options)
+        plain = omg.WadIO("test.wad")
+        map = omg.WadIO.map
+        # like a Python 2 mmap, a list has no buffer interface
+        omg.WadIO.map = lambda self, size=0: []
+        try:
+            wadio = omg.WadIO("test.wad", use_mmap=True)
+            self.assertEqual(wadio.read("THINGS"), plain.read("THINGS"))
+            self.assertFalse(wadio.use_mmap)
+            self.assertIsInstance(wadio.read("LINEDEFS"), bytes)
+            self.assertEqual(dmoncommon.extract_statistics(options), expected)
+        finally:
+            omg.WadIO.map = map
+
+    def test_find_maps(self):
+        """Enumerate maps from the WAD directory alone"""
+        from omg import omg
+        full = omg.WAD("test.wad")
+        maps = omg.WadIO("test.wad").find_maps()
+        self.assertEqual(list(maps.keys()), list(full.maps.keys()))
+        self.assertEqual(list(maps["MAP01"].keys()),
+                         list(full.maps["MAP01"].keys()))
+        maps = omg.WadIO("test.wad").find_maps("MAP0[13]")
+        self.assertEqual(list(maps.keys()), ["MAP01", "MAP03"])
+
+    def test_list_maps(self):
+        """List map thing and linedef counts"""
+        options = {"<wad>": "test.wad", "<pattern>": None}
+        wad_data = dmoncommon.list_maps(options)
+        self.assertEqual(wad_data["map list"], ["MAP01", "MAP02", "MAP03"])
+        self.assertEqual(wad_data["data"]["MAP01"]["things"], 158)
+        self.assertEqual(wad_data["data"]["MAP03"]["linedefs"], 927)
+
+    def test_locate_things(self):
+        """List the sector of each thing"""
+        options = dmon.docopt(dmon.__doc__,
+                              argv=["test.wad", "MAP03", "--sectors"])
+        wad_data = dmoncommon.locate_things(options)
+        map_data = wad_data["data"]["MAP03"]
+        self.assertEqual(len(map_data["types"]), 219)
+        self.assertEqual(len(map_data["sectors"]), 219)
+
+
+class TestMapEditing(unittest.TestCase):
+
+    def test_struct_pack_many(self):
+        """Unpack and pack map records in bulk"""
+        from omg import omg
+        wad = omg.WAD("test.wad")
+        data = bytes(wad.maps["MAP03"]["SIDEDEFS"].data)
+        sidedefs = omg.Sidedef.unpack_many(data)
+        self.assertEqual(len(sidedefs), len(data) // omg.Sidedef._fmtsize)
+        self.assertEqual(sidedefs[0].pack(),
+                         omg.Sidedef(bytes=data[:omg.Sidedef._fmtsize]).pack())
+        self.assertEqual(omg.Sidedef.pack_many(sidedefs), data)
+        self.assertFalse(hasattr(sidedefs[0], "__dict__"))
+        # Python 2 structs lack iter_unpack
+        from omg.util import iter_unpack
+        class Packer(object):
+            size = omg.Sidedef._struct.size
+            unpack_from = omg.Sidedef._struct.unpack_from
+        size = omg.Sidedef._fmtsize
+        self.assertEqual(list(iter_unpack(Packer(), data)),
+                         [omg.Sidedef._struct.unpack(data[i:i + size])
+                          for i in range(0, len(data), size)])
+
+    def test_array_map(self):
+        """Columnar map editing matches the map editor"""
+        from omg import omg
+        wad = omg.WAD("test.wad")
+        array_map = omg.ArrayMap(wad.maps["MAP01"])
+        lumps = array_map.to_lumps()
+        for name in ("VERTEXES", "LINEDEFS", "THINGS", "NODES"):
+            self.assertEqual(bytes(lumps[name].data),
+                             bytes(wad.maps["MAP01"][name].data))
+        array_map.mirror()
+        array_map.filter_things(lambda things:
+            [thing_type != 3004 for thing_type in things["type"]])
+        edit = omg.MapEditor(wad.maps["MAP01"])
+        for vertex in edit.vertexes:
+            vertex.x = -vertex.x
+        for line in edit.linedefs:
+            line.vx_a, line.vx_b = line.vx_b, line.vx_a
+        for thing in edit.things:
+            thing.x = -thing.x
+            thing.angle = (180 - thing.angle) % 360
+        edit.things = [t for t in edit.things if t.type != 3004]
+        mirrored = array_map.to_editor().to_lumps()
+        for name in ("VERTEXES", "LINEDEFS", "THINGS"):
+            self.assertEqual(bytes(mirrored[name].data),
+                             bytes(edit.to_lumps()[name].data))
+        # the documented filter also works without NumPy
+        from omg.mapedit import _Columns
+        things = _Columns.from_bytes(omg.Thing,
+                                     wad.maps["MAP01"]["THINGS"].data)
+        kept = things[[t != 3004 for t in things["type"]]]
+        self.assertEqual(list(kept["type"]), [t.type for t in edit.things])
+
+    def test_map_editor_lazy_lists(self):
+        """Decode map editor lists on first access"""
+        from omg import omg
+        wad = omg.WAD("test.wad", lazy=True)
+        lumps = wad.maps["MAP01"]
+        edit = omg.MapEditor(lumps)
+        self.assertIsNone(lumps["LINEDEFS"]._data)
+        self.assertEqual(len(edit.things), 158)
+        self.assertNotIn("linedefs", edit.__dict__)
+        saved = edit.to_lumps()
+        self.assertIs(saved["LINEDEFS"], lumps["LINEDEFS"])
+        self.assertEqual(bytes(saved["THINGS"].data),
+                         bytes(lumps["THINGS"].data))
+        # lists assigned before they are read replace their lumps
+        edit = omg.MapEditor(lumps)
+        edit.things = []
+        edit.nodes = []
+        saved = edit.to_lumps()
+        self.assertEqual(len(saved["THINGS"].data), 0)
+        self.assertEqual(len(saved["NODES"].data), 0)
+
+    def test_draw_sector_merges_edges(self):
+        """Shared edges of drawn sectors become two-sided linedefs"""
+        from omg import omg
+        edit = omg.MapEditor()
+        edit.draw_sector([(0, 0), (0, 64), (64, 64), (64, 0)])
+        edit.draw_sector([(64, 0), (64, 64), (128, 64), (128, 0)])
+        self.assertEqual(len(edit.linedefs), 7)
+        shared = edit.find_linedef((64, 64), (64, 0))
+        self.assertTrue(edit.linedefs[shared].two_sided)
+        self.assertIsNone(edit.find_linedef((0, 0), (128, 64)))
+        del edit.linedefs[shared]
+        self.assertIsNone(edit.find_linedef((64, 0), (64, 64)))
+        # edits in place are only seen after reindex
+        edit.vertexes[edit.linedefs[0].vx_a].y = 32
+        self.assertIsNone(edit.find_linedef((0, 0), (0, 32)))
+        edit.reindex()
+        self.assertEqual(edit.find_linedef((0, 0), (0, 32)), 0)
+        # but stale linedefs are never returned
+        edit.linedefs[:] = [omg.Linedef(vx_a=0, vx_b=2)] * len(edit.linedefs)
+        self.assertIsNone(edit.find_linedef((0, 0), (0, 32)))
+        # or merged with moved ones
+        edit = omg.MapEditor()
+        edit.draw_sector([(0, 0), (0, 64), (64, 64), (64, 0)])
+        for vertex in edit.vertexes:
+            vertex.x += 1000
+        edit.draw_sector([(64, 0), (64, 64), (128, 64), (128, 0)])
+        self.assertEqual(len(edit.linedefs), 8)
+        self.assertTrue(all(line.back == -1 for line in edit.linedefs))
+
+    def test_combine_sectors(self):
+        """Combined sectors lose the linedefs between them"""
+        from omg import omg
+        edit = omg.MapEditor()
+        for x in (0, 64, 128):
+            edit.draw_sector([(x, 0), (x, 64), (x + 64, 64), (x + 64, 0)])
+        self.assertEqual(len(edit.linedefs), 10)
+        edit.combine_sectors(0, [edit.sectors[1], 2])
+        self.assertEqual(len(edit.linedefs), 8)
+        self.assertEqual(set(sd.sector for sd in edit.sidedefs), set([0]))
+        # sector objects, including one listed twice, are all found
+        edit = omg.MapEditor()
+        for x in range(0, 640, 64):
+            edit.draw_sector([(x, 0), (x, 64), (x + 64, 64), (x + 64, 0)])
+        edit.sectors[9] = edit.sectors[8]
+        edit.combine_sectors(edit.sectors[0], edit.sectors[1:9])
+        self.assertEqual(len(edit.linedefs), 22)
+        self.assertEqual(set(sd.sector for sd in edit.sidedefs), set([0]))
+
+    def test_locate_sectors(self):
+        """Walking the BSP tree finds the sectors the grid finds"""
+        from omg import omg
+        from omg.spatial import SpatialIndex
+        wad = omg.WAD("test.wad")
+        edit = omg.MapEditor(wad.maps["MAP01"])
+        points = [(thing.x, thing.y) for thing in edit.things]
+        found = edit.locate_sectors(points)
+        self.assertEqual(found, SpatialIndex.from_map(edit).locate_sectors(points))
+        # without nodes the grid is searched
+        edit.nodes = []
+        self.assertEqual(edit.locate_sectors(points), found)
+        # things on two-sided linedefs of a map with many sectors
+        edit = omg.MapEditor(wad.maps["MAP03"])
+        points = [(thing.x, thing.y) for thing in edit.things]
+        for linedef in edit.linedefs:
+            a, b = edit.vertexes[linedef.vx_a], edit.vertexes[linedef.vx_b]
+            if linedef.back >= 0 and (a.x == b.x or a.y == b.y):
+                points.append(((a.x + b.x) // 2, (a.y + b.y) // 2))
+        found = edit.locate_sectors(points)
+        self.assertEqual(found[points.index((136, 768))], 0)
+        self.assertEqual(found[points.index((-920, -832))], 127)
+        self.assertEqual(found[points.index((-1632, 64))], 84)
+        for block_size in (64, 128, 256):
+            index = SpatialIndex.from_map(edit, block_size)
+            self.assertEqual(index.locate_sectors(points), found)
+
+    def test_spatial_index(self):
+        """Spatial index queries match a scan of the whole map"""
+        from omg import omg
+        from omg.spatial import SpatialIndex, _point_segment_distance
+        wad = omg.WAD("test.wad")
+        edit = omg.MapEditor(wad.maps["MAP03"])
+        index = SpatialIndex.from_map(edit)
+        x, y = edit.things[0].x, edit.things[0].y
+        near = [i for i in range(len(edit.linedefs))
+                if _point_segment_distance(x, y, index._ends(i)) <= 256]
+        self.assertTrue(near)
+        self.assertEqual(index.linedefs_in_radius(x, y, 256), near)
+        self.assertEqual(index.things_in_radius(x, y, 0), [0])
+        self.assertEqual(index.things_in_box(x, y, x, y), [0])
+        # a ray out of the map crosses a linedef
+        self.assertTrue(index.linedefs_on_ray(x, y, x + 100000, y))
+        # columnar maps give the same index
+        from omg.mapedit import ArrayMap
+        for name in ("MAP01", "MAP03"):
+            edit = omg.MapEditor(wad.maps[name])
+            index = SpatialIndex.from_map(edit)
+            array_index = SpatialIndex.from_map(ArrayMap(wad.maps[name]))
+            self.assertEqual(array_index.vertexes, index.vertexes)
+            self.assertEqual(array_index.sides, index.sides)
+            points = [(thing.x, thing.y) for thing in edit.things]
+            self.assertEqual(array_index.locate_sectors(points),
+                             index.locate_sectors(points))
+
+
+class TestGraphics(unittest.TestCase):
+
+    def test_palette_rgb_table(self):
+        """RGB table lookups find the closest palette color"""
+        import copy
+        from omg.palette import Palette
+        colors = [(0, 0, 0), (255, 255, 255), (255, 0, 0), (0, 255, 0),
+                  (0, 0, 255), (128, 128, 128), (255, 0, 0), (30, 40, 50)]
+        palette = Palette(colors, tran_index=7, tran_color=(1, 2, 3))
+        table = palette.build_rgb_table()
+        for color in [(0, 0, 0), (255, 1, 2), (129, 127, 100), (62, 64, 66),
+                      (16, 20, 25), (14, 20, 25), (100, 200, 100)]:
+            dists = [sum((a - b) ** 2 for a, b in zip(color, rgb))
+                     for rgb in colors]
+            self.assertEqual(palette.match(color), dists.index(min(dists)))
+        self.assertIs(copy.deepcopy(palette).rgb_table, table)
+
+    def test_palette_match_many(self):
+        """Matching a buffer of pixels is the same as matching each"""
+        from omg.palette import Palette
+        palette = Palette()
+        colors = [(0, 0, 0), (255, 0, 255), (13, 200, 77), (97, 95, 99),
+                  (13, 200, 77), (250, 128, 1)]
+        alphas = [255, 255, 0, 1, 255, 255]
+        rgba = bytes(bytearray(v for color, alpha in zip(colors, alphas)
+                               for v in color + (alpha,)))
+        indices, mask = palette.match_many(rgba, "RGBA")
+        expected = [Palette().match(color) if alpha else palette.tran_index
+                    for color, alpha in zip(colors, alphas)]
+        self.assertEqual(list(bytearray(indices)), expected)
+        self.assertEqual(list(bytearray(mask)), [1, 1, 0, 1, 1, 1])
+
+    def test_graphic_translate(self):
+        """Translate a graphic to another palette"""
+        from omg.palette import Palette
+        from omg.lump import Graphic
+        colors = list(reversed(Palette().colors))
+        graphic = Graphic()
+        graphic.from_pixels([None, 1, 2, 3], 2, 2, 5, 6)
+        graphic.translate(Palette(colors))
+        self.assertEqual(graphic.to_pixels(), [None, 254, 253, 252])
+        self.assertEqual(graphic.offsets, (5, 6))
+
+    def test_graphic_to_indexed(self):
+        """Decode a tall graphic to pixels and a mask"""
+        from omg.lump import Graphic
+        pixels = [None if y % 100 < 10 else (x + y) % 256
+                  for y in range(300) for x in range(3)]
+        graphic = Graphic()
+        graphic.from_pixels(pixels, 3, 300)
+        indexed, mask = graphic.to_indexed(7)
+        self.assertEqual(list(indexed), [7 if p is None else p for p in pixels])
+        self.assertEqual(list(mask), [0 if p is None else 1 for p in pixels])
+        self.assertEqual(graphic.to_pixels(), pixels)
+
+    def test_graphic_from_indexed(self):
+        """Encode pixels and a mask, splitting posts like from_pixels"""
+        from omg.lump import Graphic
+        for height in (200, 700):
+            pixels = bytearray((y * 3) % 256 for y in range(height))
+            mask = bytearray(0 if 20 <= y < 40 else 1 for y in range(height))
+            graphic = Graphic()
+            graphic.from_indexed(pixels, mask, 1, height, 4, 5)
+            self.assertEqual(graphic.to_indexed(), (bytearray(
+                p if m else 0 for p, m in zip(pixels, mask)), mask))
+            self.assertEqual(graphic.offsets, (4, 5))
+        # posts are split at row 128 of short images
+        graphic.from_indexed(b'\x01' * 200, b'\x01' * 200, 1, 200)
+        self.assertEqual(bytearray(graphic.data[12:14]), bytearray([0, 128]))
+
+    def test_bulk_graphics(self):
+        """Export and import graphics in worker processes, in order"""
+        import os
+        import shutil
+        import tempfile
+        from omg import omg
+        from omg.bulk import export_graphics, import_graphics
+        from omg.util import readfile
+        from omg.lump import Graphic, Flat
+        wad = omg.WAD()
+        for i in range(5):
+            graphic = Graphic()
+            graphic.from_pixels([None, i, i + 1, i + 2], 2, 2, i, 1)
+            wad.sprites["SPR%dA0" % i] = graphic
+            wad.flats["FLAT%d" % i] = Flat(bytes(bytearray([i]) * 4096))
+        directory = tempfile.mkdtemp()
+        try:
+            paths = export_graphics(wad.sprites, directory, format='lmp',
+                                    jobs=2)
+            self.assertEqual(len(paths), 5)
+            copy = omg.WAD()
+            self.assertEqual(import_graphics(copy.sprites, paths, jobs=2),
+                             list(wad.sprites.keys()))
+            for name in wad.sprites:
+                self.assertEqual(copy.sprites[name].data,
+                                 wad.sprites[name].data)
+            paths = export_graphics(wad.flats, directory, format='raw',
+                                    jobs=2)
+            self.assertEqual([bytearray(open(path, 'rb').read())
+                              for path in paths],
+                             [bytearray(flat.data) for flat in
+                              wad.flats.values()])
+            import_graphics(copy.flats, paths, jobs=2)
+            self.assertEqual(list(copy.flats.keys()), list(wad.flats.keys()))
+            for name in wad.flats:
+                self.assertEqual(copy.flats[name].data, wad.flats[name].data)
+            # lumps of memory-mapped WADs are sent to workers as bytes
+            path = os.path.join(directory, "graphics.wad")
+            wad.to_file(path)
+            mapped = omg.WAD(omg.WadIO(path, use_mmap=True))
+            exported = export_graphics(mapped.sprites, directory,
+                                       format='lmp', jobs=2)
+            self.assertEqual([readfile(path) for path in exported],
+                             [bytes(lump.data) for lump in
+                              wad.sprites.values()])
+            # pictures need their size, which raw files don't keep
+            self.assertRaises(ValueError, export_graphics, wad.sprites,
+                              directory, format='raw')
+            self.assertRaises(ValueError, import_graphics, copy.sprites,
+                              paths)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_bulk_images_keep_offsets(self):
+        """Imported images keep the offsets of the lumps they replace"""
+        try:
+            import PIL
+        except ImportError:
+            self.skipTest("PIL is not installed")
+        import shutil
+        import tempfile
+        from omg import omg
+        from omg.bulk import export_graphics, import_graphics
+        from omg.lump import Graphic
+        wad = omg.WAD()
+        for i in range(3):
+            graphic = Graphic()
+            graphic.from_pixels([None, i, i + 1, i + 2], 2, 2, 10 + i, 20)
+            wad.sprites["SPR%dA0" % i] = graphic
+        directory = tempfile.mkdtemp()
+        try:
+            paths = export_graphics(wad.sprites, directory, jobs=2)
+            expected = [(name, lump.offsets, lump.to_pixels())
+                        for name, lump in wad.sprites.items()]
+            import_graphics(wad.sprites, paths, jobs=2)
+            self.assertEqual([(name, lump.offsets, lump.to_pixels())
+                              for name, lump in wad.sprites.items()],
+                             expected)
+        finally:
+            shutil.rmtree(directory)
+
+
 class TestBaselineData(unittest.TestCase):
 
     def test_baselines_values_are_numbers(self):